@@ -1,6 +1,7 @@
 # app.py (Streamlit Cloud) — SIN Telegram / SIN FastAPI
 import streamlit as st
 import pandas as pd
+import numpy as np
 from supabase import create_client
 from datetime import date, datetime, timedelta
 import calendar
@@ -8,8 +9,14 @@ from dateutil.relativedelta import relativedelta
 import plotly.express as px
 import plotly.graph_objects as go
 import time
-import re
 import math
+import html
+import io
+import os
+import json
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # =========================================================
 # 1) CONFIG UI
@@ -80,6 +87,17 @@ div[data-testid="stMetricLabel"] p { font-weight: 600 !important; opacity: 0.85;
   text-align: center;
   border: 1px solid rgba(128, 128, 128, 0.2);
 }
+.cal-grid {
+  display: grid;
+  grid-template-columns: repeat(7, minmax(0, 1fr));
+  gap: 8px;
+}
+.cal-grid .day-card { height: auto; min-height: 110px; margin-bottom: 0; }
+.cal-head { text-align: center; font-weight: 600; opacity: 0.7; }
+.day-evs { margin-top: auto; font-size: 0.75rem; }
+.day-evs summary { cursor: pointer; opacity: 0.8; }
+.day-evs table { width: 100%; border-collapse: collapse; margin-top: 4px; }
+.day-evs td { padding: 2px 4px; border-top: 1px solid rgba(128, 128, 128, 0.2); }
 .small-muted { opacity: 0.75; font-size: 0.88rem; }
 .badge {
   display:inline-block; padding: 4px 8px; border-radius: 999px;
@@ -106,11 +124,203 @@ def init_connection():
 
 supabase = init_connection()
 
-def invalidate_caches():
+# ---------------------------------------------------------
+# Espejo local (SQLite) de las tablas con fecha.
+#   - Se siembra una vez (paginado) y luego trae solo filas con updated_at >= watermark.
+#   - Los borrados llegan por la tabla "tombstones" (trigger on delete).
+#   - Requiere supabase/migrations/*_delta_sync.sql; si falla, se lee directo de Supabase.
+# ---------------------------------------------------------
+DATED_TABLES = {
+    "movimientos": "fecha",
+    "compras_tarjeta": "fecha_compra",
+    "cuotas_tarjeta": "fecha_cuota",
+}
+MIRROR_PAGE = 1000        # max-rows por request de PostgREST
+MIRROR_SYNC_SECONDS = 30  # cada cuánto se consulta el delta como mucho
+MIRROR_LAG_SECONDS = 300  # margen para transacciones que commitean tarde (el watermark no pasa de now - lag)
+
+class LocalMirror:
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.last_sync = 0.0
+        self.ready = False  # True tras el primer sync completo en este proceso
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS filas (
+                tabla TEXT NOT NULL,
+                id TEXT NOT NULL,
+                fecha TEXT,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (tabla, id)
+            );
+            CREATE INDEX IF NOT EXISTS filas_tabla_fecha ON filas (tabla, fecha);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                tabla TEXT PRIMARY KEY,
+                watermark TEXT
+            );
+            """
+        )
+
+    def _watermark(self, tabla: str) -> tuple:
+        """(timestamp, id) de la última fila aplicada; id None si quedó un watermark viejo de sólo timestamp."""
+        row = self.conn.execute("SELECT watermark FROM sync_state WHERE tabla = ?", (tabla,)).fetchone()
+        if not row or not row[0]:
+            return None, None
+        try:
+            ts, last_id = json.loads(row[0])
+        except ValueError:
+            return row[0], None
+        return ts, last_id
+
+    def _set_watermark(self, tabla: str, ts: str, last_id):
+        self.conn.execute(
+            "INSERT INTO sync_state (tabla, watermark) VALUES (?, ?) "
+            "ON CONFLICT(tabla) DO UPDATE SET watermark = excluded.watermark",
+            (tabla, json.dumps([ts, last_id])),
+        )
+
+    def _delta(self, tabla: str, cols: str, ts_col: str):
+        """
+        Páginas de filas posteriores al watermark, por keyset (ts_col, id): filas con el mismo
+        timestamp (default now() del backfill, inserts en lote) no se vuelven a bajar.
+        El timestamp es now() del inicio de la transacción, no del commit: el watermark sólo avanza
+        hasta filas más viejas que MIRROR_LAG_SECONDS, así una transacción lenta que commitea
+        después de un sync igual se lee en el siguiente (las filas recientes se releen; aplicar es idempotente).
+        """
+        ts, last_id = self._watermark(tabla)
+        limite = datetime.now().astimezone() - timedelta(seconds=MIRROR_LAG_SECONDS)
+        asentado = True  # mientras las filas leídas sean viejas, el watermark las acompaña
+        while True:
+            q = supabase.table(tabla).select(cols).order(ts_col).order("id")
+            if ts and last_id is not None:
+                q = q.or_(f'{ts_col}.gt."{ts}",and({ts_col}.eq."{ts}",id.gt."{last_id}")')
+            elif ts:
+                # watermark viejo sin id: una última vez con gte
+                q = q.gte(ts_col, ts)
+            rows = q.limit(MIRROR_PAGE).execute().data or []
+            if rows:
+                yield rows
+                if asentado:
+                    viejas = [r for r in rows if datetime.fromisoformat(r[ts_col]) < limite]
+                    if viejas:
+                        self._set_watermark(tabla, viejas[-1][ts_col], viejas[-1]["id"])
+                    asentado = len(viejas) == len(rows)
+                ts, last_id = rows[-1][ts_col], rows[-1]["id"]
+            if len(rows) < MIRROR_PAGE:
+                return
+
+    def _sync_table(self, tabla: str, fecha_col: str):
+        for rows in self._delta(tabla, "*", "updated_at"):
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO filas (tabla, id, fecha, payload) VALUES (?, ?, ?, ?)",
+                [(tabla, str(r["id"]), r.get(fecha_col), json.dumps(r)) for r in rows],
+            )
+
+    def _sync_tombstones(self):
+        for rows in self._delta("tombstones", "id, tabla, row_id, deleted_at", "deleted_at"):
+            self.conn.executemany(
+                "DELETE FROM filas WHERE tabla = ? AND id = ?",
+                [(r["tabla"], str(r["row_id"])) for r in rows],
+            )
+
+    def sync(self, force: bool = False):
+        with self.lock:
+            if not force and time.time() - self.last_sync < MIRROR_SYNC_SECONDS:
+                return
+            # se marca antes de sincronizar: si falla, no reintentamos en cada lectura
+            self.last_sync = time.time()
+            with self.conn:
+                for tabla, fecha_col in DATED_TABLES.items():
+                    self._sync_table(tabla, fecha_col)
+                self._sync_tombstones()
+            self.ready = True
+
+    def mark_dirty(self):
+        self.last_sync = 0.0
+
+    def read(self, tabla: str, desde: date, hasta: date) -> list:
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT payload FROM filas WHERE tabla = ? AND fecha >= ? AND fecha <= ? ORDER BY fecha",
+                (tabla, str(desde), str(hasta)),
+            )
+            return [json.loads(p) for (p,) in cur.fetchall()]
+
+    def read_ids(self, tabla: str, ids) -> list:
+        ids = [str(i) for i in ids]
+        out = []
+        with self.lock:
+            for i in range(0, len(ids), 500):  # límite de parámetros de sqlite
+                chunk = ids[i:i+500]
+                cur = self.conn.execute(
+                    f"SELECT payload FROM filas WHERE tabla = ? AND id IN ({','.join('?' * len(chunk))})",
+                    (tabla, *chunk),
+                )
+                out += [json.loads(p) for (p,) in cur.fetchall()]
+        return out
+
+@st.cache_resource
+def init_mirror():
+    if str(st.secrets.get("LOCAL_MIRROR", "1")) == "0":
+        return None
+    return LocalMirror(st.secrets.get("MIRROR_PATH", ".cache/finanzas_mirror.sqlite"))
+
+mirror = init_mirror()
+
+def mirror_rows(tabla: str, desde: date, hasta: date):
+    """Filas del espejo local para el rango; None si el espejo no está disponible."""
+    if mirror is None:
+        return None
     try:
-        st.cache_data.clear()
+        mirror.sync()
     except Exception:
         pass
+    if not mirror.ready:
+        return None
+    return mirror.read(tabla, desde, hasta)
+
+# ---------------------------------------------------------
+# Versiones de cache por tabla.
+#   - Cada lector cacheado recibe la versión de las tablas que lee como argumento,
+#     así una escritura solo invalida las entradas que dependen de esa tabla.
+#   - En tablas con fecha se versiona por día: una ventana (desde, hasta) solo cambia
+#     de clave si hubo escrituras en fechas dentro de la ventana.
+# ---------------------------------------------------------
+@st.cache_resource
+def _cache_versions() -> dict:
+    # compartido entre sesiones: {tabla: int} y {(tabla, "fechas"): {fecha: int}}
+    return {}
+
+_versions_lock = threading.Lock()
+
+def table_version(tabla: str) -> int:
+    return _cache_versions().get(tabla, 0)
+
+def window_version(tabla: str, desde: date, hasta: date) -> tuple:
+    """Clave de versión de una ventana: escrituras sin fecha + escrituras con fecha dentro del rango."""
+    por_fecha = _cache_versions().get((tabla, "fechas"), {})
+    with _versions_lock:
+        en_rango = sum(n for f, n in por_fecha.items() if desde <= f <= hasta)
+    return table_version(tabla), en_rango
+
+def invalidate(tabla: str, *fechas):
+    """
+    Invalida solo los lectores de `tabla`. Con fechas, solo las ventanas que las contienen;
+    sin fechas (ej. borrado en cascada), todas las ventanas de la tabla.
+    """
+    if mirror is not None and tabla in DATED_TABLES:
+        mirror.mark_dirty()
+    versions = _cache_versions()
+    with _versions_lock:
+        if fechas:
+            por_fecha = versions.setdefault((tabla, "fechas"), {})
+            for f in fechas:
+                f = pd.to_datetime(f).date()
+                por_fecha[f] = por_fecha.get(f, 0) + 1
+        else:
+            versions[tabla] = versions.get(tabla, 0) + 1
 
 # =========================================================
 # 4) LOGIN (bcrypt hash en st.secrets)
@@ -184,40 +394,151 @@ def parse_amount(s: str) -> float:
         s = s.replace(",", ".")
     return abs(float(s))
 
-def categorize_desc(desc: str, df_cat: pd.DataFrame) -> str:
-    # reglas simples por merchant / texto
-    d = (desc or "").upper()
-
-    rules = [
-        (r"(PEDIDOSYA|RAPPI|DELIVERY|HAMBURG|PIZZA|KFC|MCDONALD|BURGER)", "Comida"),
-        (r"(UBER|DIDI|CABIFY|TAXI|SUBE)", "Transporte"),
-        (r"(NETFLIX|SPOTIFY|DISNEY|HBO|PRIME VIDEO|YOUTUBE)", "Suscripciones"),
-        (r"(FARMAC|FARMACITY|PERFUMER|DROGUER)", "Salud"),
-        (r"(SUPERMERC|COTO|DIA|JUMBO|CARREFOUR|CHANGO|VEA)", "Supermercado"),
-        (r"(MERCADOPAGO|MP\*|MERCADO LIBRE|ML\*)", "MercadoPago"),
-        (r"(LUZ|EDENOR|EDESUR|AYSA|GAS|METROGAS|NATURGY|INTERNET|FIBERTEL|TELECENTRO|MOVISTAR|CLARO|PERSONAL)", "Servicios"),
-    ]
-
-    # si existe categoría exacta, usala
-    existing = set((df_cat["nombre"].astype(str)).str.lower().tolist()) if not df_cat.empty else set()
-
-    for pat, cat in rules:
-        if re.search(pat, d):
-            if cat.lower() in existing:
-                return cat
-            # fallback a "General" si no existe
+# ---------------------------------------------------------
+# Lectura de resúmenes bancarios (Excel/CSV)
+# ---------------------------------------------------------
+def _unique_header(cells) -> list:
+    # mismos nombres que pandas: vacías -> "Unnamed: i", repetidas -> "X.1", "X.2"...
+    out, seen = [], {}
+    for i, c in enumerate(cells):
+        name = f"Unnamed: {i}" if c is None or str(c).strip() == "" else str(c).strip()
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        out.append(name)
+    return out
+
+def iter_excel_rows(file):
+    """
+    Lee la primera hoja en modo streaming (read_only) y en una sola pasada:
+    la primera fila con "FECHA" es el header (si no hay, la primera fila) y el resto se devuelve
+    como filas de datos. Devuelve (header, generador de filas).
+    """
+    import openpyxl
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    ws = wb.worksheets[0]
+    ws.reset_dimensions()  # algunos exports declaran mal el rango de la hoja
+    rows = ws.iter_rows(values_only=True)
+
+    antes = []  # filas previas al header (solo se usan si nunca aparece "FECHA")
+    header = None
+    for row in rows:
+        if any("FECHA" in str(x).upper() for x in row if x is not None):
+            header = row
             break
+        antes.append(row)
+
+    def data_rows():
+        try:
+            if header is None:
+                yield from antes[1:]
+            else:
+                yield from rows
+        finally:
+            wb.close()
+
+    if header is None:
+        return _unique_header(antes[0] if antes else []), data_rows()
+    return _unique_header(header), data_rows()
+
+@st.cache_data(max_entries=4)
+def read_bank_file(data: bytes, name: str) -> pd.DataFrame:
+    if name.endswith(".csv"):
+        df = pd.read_csv(io.BytesIO(data))
+    else:
+        header, rows = iter_excel_rows(io.BytesIO(data))
+        # como pandas: sin las celdas vacías del final, y las columnas de datos sin título quedan "Unnamed: i"
+        rows = [r[:max((i + 1 for i, v in enumerate(r) if v is not None), default=0)] for r in rows]
+        width = max([len(header)] + [len(r) for r in rows])
+        header = list(header) + [f"Unnamed: {i}" for i in range(len(header), width)]
+        df = pd.DataFrame([tuple(r) + (None,) * (width - len(r)) for r in rows], columns=header)
+    return df.dropna(how="all").reset_index(drop=True)
+
+# formato conocido por firma de header -> {"fecha", "detalle", "pesos"}
+LAYOUT_KEYWORDS = {
+    "fecha": ("FECHA",),
+    "detalle": ("DETALLE", "DESCRIP", "CONCEPTO", "COMERCIO", "ESTABLECIMIENTO", "REFERENCIA"),
+    "pesos": ("PESOS", "IMPORTE", "MONTO"),
+}
+LAYOUT_EXCLUDE = {"pesos": ("DOLAR", "DÓLAR", "U$S", "USD")}
 
-    if "general" in existing:
-        return "General"
-    # si no existe General, devolvemos primera
-    return df_cat.iloc[0]["nombre"] if not df_cat.empty else "General"
+@st.cache_resource
+def _layout_cache() -> dict:
+    return {}
+
+def header_signature(columns) -> tuple:
+    return tuple(str(c).strip().upper() for c in columns)
+
+def detect_layout(columns) -> dict:
+    """Mapeo Fecha/Detalle/Pesos; si la firma ya se importó antes, se reusa sin detectar."""
+    sig = header_signature(columns)
+    cached = _layout_cache().get(sig)
+    if cached:
+        return cached
+    mapping = {}
+    for key, keywords in LAYOUT_KEYWORDS.items():
+        excl = LAYOUT_EXCLUDE.get(key, ())
+        for kw in keywords:
+            hit = next((c for c, n in zip(columns, sig)
+                        if kw in n and not any(x in n for x in excl) and c not in mapping.values()), None)
+            if hit is not None:
+                mapping[key] = hit
+                break
+    return mapping
+
+def remember_layout(columns, mapping: dict):
+    _layout_cache()[header_signature(columns)] = mapping
+
+# reglas simples por merchant / texto, en orden de prioridad
+CATEGORY_RULES = [
+    (r"PEDIDOSYA|RAPPI|DELIVERY|HAMBURG|PIZZA|KFC|MCDONALD|BURGER", "Comida"),
+    (r"UBER|DIDI|CABIFY|TAXI|SUBE", "Transporte"),
+    (r"NETFLIX|SPOTIFY|DISNEY|HBO|PRIME VIDEO|YOUTUBE", "Suscripciones"),
+    (r"FARMAC|FARMACITY|PERFUMER|DROGUER", "Salud"),
+    (r"SUPERMERC|COTO|DIA|JUMBO|CARREFOUR|CHANGO|VEA", "Supermercado"),
+    (r"MERCADOPAGO|MP\*|MERCADO LIBRE|ML\*", "MercadoPago"),
+    (r"LUZ|EDENOR|EDESUR|AYSA|GAS|METROGAS|NATURGY|INTERNET|FIBERTEL|TELECENTRO|MOVISTAR|CLARO|PERSONAL", "Servicios"),
+]
+
+class CategoryEngine:
+    """
+    Categoriza una columna entera de descripciones.
+    Las categorías se resuelven una sola vez por importación: cada regla apunta a su
+    categoría si existe, o a "General" / la primera categoría si no (la primera regla
+    que matchea gana). Las descripciones repetidas se evalúan una sola vez.
+    """
+    def __init__(self, df_cat: pd.DataFrame):
+        names = [str(n) for n in df_cat["nombre"]] if not df_cat.empty else []
+        by_lower = {n.lower(): n for n in names}
+        if "general" in by_lower:
+            self.fallback = by_lower["general"]
+        else:
+            self.fallback = names[0] if names else "General"
+        self.targets = [by_lower.get(cat.lower(), self.fallback) for _, cat in CATEGORY_RULES]
+
+    def classify(self, descs: pd.Series) -> pd.Series:
+        if descs.empty:
+            return pd.Series([], index=descs.index, dtype=object)
+        codes, uniques = pd.factorize(descs.fillna("").astype(str).str.upper())
+        uniq = pd.Series(uniques, dtype="str")
+        masks = [uniq.str.contains(pat, regex=True).to_numpy(dtype=bool) for pat, _ in CATEGORY_RULES]
+        cats = np.select(masks, self.targets, default=self.fallback)
+        return pd.Series(cats[codes], index=descs.index, dtype=object)
 
 # =========================================================
 # 6) DATA ACCESS (cacheado)
 # =========================================================
+# lecturas de este render (el script se re-ejecuta en cada render, así que arranca en cero):
+#   "llamadas": pedidos de datos de la página; "descargas": cache miss que fue a la base / espejo
+FETCH_LOG = {"llamadas": {}, "descargas": {}}
+
+def log_fetch(tipo: str, nombre: str):
+    FETCH_LOG[tipo][nombre] = FETCH_LOG[tipo].get(nombre, 0) + 1
+
 @st.cache_data(ttl=60)
-def get_maestros():
+def _fetch_maestros(version: tuple):
     cta = pd.DataFrame(supabase.table("cuentas").select("*").execute().data or [])
     cat = pd.DataFrame(supabase.table("categorias").select("*").execute().data or [])
     try:
@@ -231,84 +552,299 @@ def get_maestros():
         su = 0.0
     return cta, cat, su
 
-@st.cache_data(ttl=45)
-def get_movimientos(desde: date, hasta: date, back_months: int = 0) -> pd.DataFrame:
-    desde_ext = desde - relativedelta(months=back_months) if back_months else desde
-    resp = (
-        supabase.table("movimientos")
-        .select("*, categorias(nombre, icono), cuentas:cuentas!cuenta_id(nombre, tipo, dia_cierre, dia_vencimiento)")
-        .gte("fecha", str(desde_ext))
-        .lte("fecha", str(hasta))
-        .order("fecha")
-        .execute()
-    )
-    if not resp.data:
+def get_maestros():
+    return _fetch_maestros((table_version("cuentas"), table_version("categorias"), table_version("configuracion")))
+
+def _nested_col(nested: list, key: str, default) -> pd.Series:
+    return pd.Series([n.get(key) for n in nested], dtype=object).fillna(default)
+
+def flatten_movimientos(rows: list, cat_by_id: dict | None = None, cta_by_id: dict | None = None) -> pd.DataFrame:
+    """
+    Aplana los joins embebidos (categorias / cuentas) armando columnas desde listas,
+    sin copiar cada dict. Devuelve categoria, cuenta, tipo_cta, cierre, vto.
+    Con cat_by_id / cta_by_id (filas crudas del espejo) el join se resuelve por id.
+    """
+    if not rows:
         return pd.DataFrame()
+    keys = [k for k in rows[0] if k not in ("categorias", "cuentas")]
+    df = pd.DataFrame({k: [r.get(k) for r in rows] for k in keys})
+
+    if cat_by_id is None:
+        cats = [r.get("categorias") or {} for r in rows]
+    else:
+        cats = [cat_by_id.get(str(r.get("categoria_id"))) or {} for r in rows]
+    if cta_by_id is None:
+        ctas = [r.get("cuentas") or {} for r in rows]
+    else:
+        ctas = [cta_by_id.get(str(r.get("cuenta_id"))) or {} for r in rows]
+    df["categoria"] = (_nested_col(cats, "icono", "") + " " + _nested_col(cats, "nombre", "General")).str.strip()
+    df["cuenta"] = _nested_col(ctas, "nombre", "Efectivo")
+    df["tipo_cta"] = _nested_col(ctas, "tipo", "DEBITO")
+    df["cierre"] = _nested_col(ctas, "dia_cierre", 25)
+    df["vto"] = _nested_col(ctas, "dia_vencimiento", 5)
+    return df
 
-    data = []
-    for d in resp.data:
-        r = d.copy()
-        r["categoria"] = f"{(d.get('categorias') or {}).get('icono','')} {(d.get('categorias') or {}).get('nombre','General')}".strip()
-        r["cuenta"] = (d.get("cuentas") or {}).get("nombre", "Efectivo")
-        r["tipo_cta"] = (d.get("cuentas") or {}).get("tipo", "DEBITO")
-        r["cierre"] = (d.get("cuentas") or {}).get("dia_cierre", 25)
-        r["vto"] = (d.get("cuentas") or {}).get("dia_vencimiento", 5)
-        r.pop("categorias", None)
-        r.pop("cuentas", None)
-        data.append(r)
-
-    df = pd.DataFrame(data)
+def _load_movimientos(desde_ext: date, hasta: date) -> pd.DataFrame:
+    log_fetch("descargas", "movimientos")
+    rows = mirror_rows("movimientos", desde_ext, hasta)
+    if rows is not None:
+        # filas crudas: el join con cuentas/categorias se resuelve con los maestros
+        cta, cat, _ = get_maestros()
+        df = flatten_movimientos(
+            rows,
+            cat_by_id={str(r["id"]): r for r in cat.to_dict("records")},
+            cta_by_id={str(r["id"]): r for r in cta.to_dict("records")},
+        )
+    else:
+        resp = (
+            supabase.table("movimientos")
+            .select("*, categorias(nombre, icono), cuentas:cuentas!cuenta_id(nombre, tipo, dia_cierre, dia_vencimiento)")
+            .gte("fecha", str(desde_ext))
+            .lte("fecha", str(hasta))
+            .order("fecha")
+            .execute()
+        )
+        df = flatten_movimientos(resp.data or [])
     if not df.empty:
         df["fecha"] = pd.to_datetime(df["fecha"]).dt.date
         df["monto"] = pd.to_numeric(df["monto"], errors="coerce").fillna(0.0)
     return df
 
+def get_movimientos(desde: date, hasta: date, back_months: int = 0) -> pd.DataFrame:
+    log_fetch("llamadas", "movimientos")
+    desde_ext = desde - relativedelta(months=back_months) if back_months else desde
+    return read_partitioned("movimientos", desde_ext, hasta)
+
 @st.cache_data(ttl=45)
-def get_suscripciones():
+def _fetch_suscripciones(version: int):
     return pd.DataFrame(supabase.table("suscripciones").select("*").execute().data or [])
 
+def get_suscripciones():
+    return _fetch_suscripciones(table_version("suscripciones"))
+
 @st.cache_data(ttl=45)
-def get_metas():
+def _fetch_metas(version: int):
     return pd.DataFrame(supabase.table("metas").select("*").execute().data or [])
 
-@st.cache_data(ttl=45)
-def get_compras_tarjeta(desde: date, hasta: date) -> pd.DataFrame:
+def get_metas():
+    return _fetch_metas(table_version("metas"))
+
+def _load_compras_tarjeta(desde: date, hasta: date) -> pd.DataFrame:
     # compras (entidad)
-    resp = (
-        supabase.table("compras_tarjeta")
-        .select("*")
-        .gte("fecha_compra", str(desde))
-        .lte("fecha_compra", str(hasta))
-        .order("fecha_compra")
-        .execute()
-    )
-    df = pd.DataFrame(resp.data or [])
+    log_fetch("descargas", "compras_tarjeta")
+    rows = mirror_rows("compras_tarjeta", desde, hasta)
+    if rows is None:
+        rows = (
+            supabase.table("compras_tarjeta")
+            .select("*")
+            .gte("fecha_compra", str(desde))
+            .lte("fecha_compra", str(hasta))
+            .order("fecha_compra")
+            .execute()
+        ).data
+    df = pd.DataFrame(rows or [])
     if not df.empty:
         df["fecha_compra"] = pd.to_datetime(df["fecha_compra"]).dt.date
         df["monto_total"] = pd.to_numeric(df["monto_total"], errors="coerce").fillna(0.0)
     return df
 
-@st.cache_data(ttl=45)
-def get_cuotas_tarjeta(desde: date, hasta: date) -> pd.DataFrame:
+def get_compras_tarjeta(desde: date, hasta: date) -> pd.DataFrame:
+    return read_partitioned("compras_tarjeta", desde, hasta)
+
+def _load_cuotas_tarjeta(desde: date, hasta: date) -> pd.DataFrame:
     # cuotas (para presupuesto mensual / proyecciones)
-    resp = (
-        supabase.table("cuotas_tarjeta")
-        .select("*")
-        .gte("fecha_cuota", str(desde))
-        .lte("fecha_cuota", str(hasta))
-        .order("fecha_cuota")
-        .execute()
-    )
-    df = pd.DataFrame(resp.data or [])
+    log_fetch("descargas", "cuotas_tarjeta")
+    rows = mirror_rows("cuotas_tarjeta", desde, hasta)
+    if rows is None:
+        rows = (
+            supabase.table("cuotas_tarjeta")
+            .select("*")
+            .gte("fecha_cuota", str(desde))
+            .lte("fecha_cuota", str(hasta))
+            .order("fecha_cuota")
+            .execute()
+        ).data
+    df = pd.DataFrame(rows or [])
     if not df.empty:
         df["fecha_cuota"] = pd.to_datetime(df["fecha_cuota"]).dt.date
         df["monto_cuota"] = pd.to_numeric(df["monto_cuota"], errors="coerce").fillna(0.0)
     return df
 
+def get_cuotas_tarjeta(desde: date, hasta: date) -> pd.DataFrame:
+    return read_partitioned("cuotas_tarjeta", desde, hasta)
+
+# ---------------------------------------------------------
+# Particiones por mes calendario.
+#   - Cada rango se arma con sus meses: rangos solapados (mes actual, 2 meses, 6 meses,
+#     todo el histórico) reusan las mismas particiones en vez de descargar de nuevo.
+#   - Los meses que terminan antes del último cierre de tarjeta casi no cambian: se cachean
+#     por horas (las escrituras locales cambian su versión; las del bot, con fecha pasada,
+#     aparecen al vencer el TTL).
+# ---------------------------------------------------------
+_PARTITION_LOADERS = {
+    "movimientos": _load_movimientos,
+    "compras_tarjeta": _load_compras_tarjeta,
+    "cuotas_tarjeta": _load_cuotas_tarjeta,
+}
+# tablas extra que entran en la clave (movimientos se une con cuentas/categorias)
+_PARTITION_DEPS = {"movimientos": ("cuentas", "categorias")}
+
+def month_end(mes: date) -> date:
+    return mes + relativedelta(months=1) - timedelta(days=1)
+
+PARTITION_CLOSED_TTL = 3 * 3600  # segundos
+
+@st.cache_data(ttl=PARTITION_CLOSED_TTL, max_entries=1000)
+def _partition_closed(tabla: str, mes: date, version: tuple) -> pd.DataFrame:
+    return _PARTITION_LOADERS[tabla](mes, month_end(mes))
+
+@st.cache_data(ttl=45)
+def _partition_open(tabla: str, mes: date, version: tuple) -> pd.DataFrame:
+    return _PARTITION_LOADERS[tabla](mes, month_end(mes))
+
+def closed_months_limit() -> date:
+    """Último cierre de tarjeta (el más viejo entre tarjetas); sin tarjetas, inicio del mes actual."""
+    hoy = date.today()
+    cta, _, _ = get_maestros()
+    cards = cta[cta["tipo"] == "CREDITO"] if not cta.empty else cta
+    if cards.empty:
+        return hoy.replace(day=1)
+    cycles = [card_cycle(int(c or 25), int(v or 5)) for c, v in zip(cards["dia_cierre"].fillna(0), cards["dia_vencimiento"].fillna(0))]
+    return min(cyc.cierre(cyc.last_index(hoy)) for cyc in cycles)
+
+def read_partitioned(tabla: str, desde: date, hasta: date) -> pd.DataFrame:
+    fecha_col = DATED_TABLES[tabla]
+    limite = closed_months_limit()
+    deps = tuple(table_version(t) for t in _PARTITION_DEPS.get(tabla, ()))
+
+    parts = []
+    mes = desde.replace(day=1)
+    while mes <= hasta:
+        fin = month_end(mes)
+        version = (window_version(tabla, mes, fin),) + deps
+        fetch = _partition_closed if fin < limite else _partition_open
+        df_mes = fetch(tabla, mes, version)
+        if not df_mes.empty:
+            parts.append(df_mes)
+        mes += relativedelta(months=1)
+
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat(parts, ignore_index=True)
+    df = df[(df[fecha_col] >= desde) & (df[fecha_col] <= hasta)]
+    return df.reset_index(drop=True)
+
+# ---------------------------------------------------------
+# Inversiones: movimientos con subtipo INVERSION (índice parcial), sin tope de fechas
+# ---------------------------------------------------------
+def missing_column(e: Exception, col: str) -> bool:
+    """Error de PostgREST por columna inexistente: 42703 en filtros, PGRST204 en escrituras."""
+    msg = str(e)
+    return col in msg and ("42703" in msg or "PGRST204" in msg)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_inversiones(version: tuple) -> pd.DataFrame:
+    def paginar(filtro) -> list:
+        rows, start = [], 0
+        while True:
+            # builder nuevo por request: los filtros de postgrest modifican el builder en el lugar
+            q = filtro(supabase.table("movimientos").select("id, fecha, descripcion, monto, cuenta_id"))
+            page = q.order("fecha", desc=True).order("id", desc=True) \
+                    .range(start, start + MIRROR_PAGE - 1).execute().data or []
+            rows += page
+            if len(page) < MIRROR_PAGE:
+                return rows
+            start += MIRROR_PAGE
+
+    try:
+        rows = paginar(lambda q: q.eq("subtipo", "INVERSION"))
+    except Exception as e:
+        if not missing_column(e, "subtipo"):
+            raise
+        # migración pendiente: el marcador viejo en la descripción
+        rows = paginar(lambda q: q.ilike("descripcion", "%Inversión:%"))
+    df = pd.DataFrame(rows)
+    if not df.empty:
+        df["fecha"] = pd.to_datetime(df["fecha"]).dt.date
+        df["monto"] = pd.to_numeric(df["monto"], errors="coerce").fillna(0.0)
+    return df
+
+def get_inversiones() -> pd.DataFrame:
+    return _fetch_inversiones(window_version("movimientos", date.min, date.max))
+
+# ---------------------------------------------------------
+# Historial paginado: keyset sobre (fecha, id) desc + filtros en el servidor
+# ---------------------------------------------------------
+HIST_PAGE = 50
+HIST_TABLES = {
+    "movimientos": {
+        "fecha": "fecha", "monto": "monto",
+        "select": "id, fecha, descripcion, monto, tipo, cuenta_id, categoria_id, source, raw_reference",
+    },
+    "compras_tarjeta": {
+        "fecha": "fecha_compra", "monto": "monto_total",
+        "select": "id, fecha_compra, descripcion, monto_total, cuotas_total, cuenta_id, categoria_id, source, raw_reference",
+    },
+}
+
+def like_escape(texto: str) -> str:
+    """Escapa los comodines de LIKE / ILIKE (\\, %, _) para buscar el texto literal."""
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+@st.cache_data(ttl=60, max_entries=200, show_spinner=False)
+def _fetch_history_page(tabla: str, filtros: tuple, cursor: tuple | None, size: int, version: tuple):
+    cfg = HIST_TABLES[tabla]
+    fc = cfg["fecha"]
+    f = dict(filtros)
+    q = supabase.table(tabla).select(cfg["select"])
+    if f.get("desde"):
+        q = q.gte(fc, str(f["desde"]))
+    if f.get("hasta"):
+        q = q.lte(fc, str(f["hasta"]))
+    if f.get("cuenta_id"):
+        q = q.eq("cuenta_id", f["cuenta_id"])
+    if f.get("categoria_id"):
+        q = q.eq("categoria_id", f["categoria_id"])
+    if f.get("tipo"):
+        q = q.eq("tipo", f["tipo"])
+    if f.get("monto_min") is not None:
+        q = q.gte(cfg["monto"], float(f["monto_min"]))
+    if f.get("monto_max") is not None:
+        q = q.lte(cfg["monto"], float(f["monto_max"]))
+    if f.get("texto"):
+        # el texto del usuario va literal dentro del ilike
+        q = q.ilike("descripcion", "%" + like_escape(f["texto"].strip()) + "%")
+    if cursor:
+        # siguiente página: todo lo estrictamente "anterior" a la última fila vista
+        c_fecha, c_id = cursor
+        q = q.or_(f"{fc}.lt.{c_fecha},and({fc}.eq.{c_fecha},id.lt.{c_id})")
+    rows = q.order(fc, desc=True).order("id", desc=True).limit(size + 1).execute().data or []
+    return rows[:size], len(rows) > size
+
+def get_history_page(tabla: str, filtros: dict, cursor: tuple | None = None, size: int = HIST_PAGE):
+    """
+    Una página del historial (solo esas filas viajan y se materializan).
+    Devuelve (df, cursor_siguiente | None). La versión de caché cubre el rango de fechas filtrado.
+    """
+    desde = filtros.get("desde") or date.min
+    hasta = filtros.get("hasta") or date.max
+    rows, has_more = _fetch_history_page(
+        tabla, tuple(sorted(filtros.items())), cursor, size, window_version(tabla, desde, hasta)
+    )
+    df = pd.DataFrame(rows)
+    fc = HIST_TABLES[tabla]["fecha"]
+    nxt = (str(rows[-1][fc]), str(rows[-1]["id"])) if rows and has_more else None
+    if not df.empty:
+        df[fc] = pd.to_datetime(df[fc]).dt.date
+    return df, nxt
+
 # =========================================================
 # 7) DB WRITES
 # =========================================================
-def db_save_mov(fecha, monto, desc, cta_id, cat_id, tipo, dest_id=None, source="manual", raw_reference=None, merchant=None):
+INSERT_BATCH = 500  # filas por request en inserts masivos
+
+def mov_payload(fecha, monto, desc, cta_id, cat_id, tipo, dest_id=None, source="manual", raw_reference=None,
+                merchant=None, idempotency_key=None, subtipo=None) -> dict:
     payload = {
         "fecha": str(fecha),
         "monto": float(monto),
@@ -319,42 +855,78 @@ def db_save_mov(fecha, monto, desc, cta_id, cat_id, tipo, dest_id=None, source="
         "source": source,
         "raw_reference": raw_reference,
         "merchant": merchant or desc,
+        "cuenta_destino_id": dest_id or None,
     }
-    if dest_id:
-        payload["cuenta_destino_id"] = dest_id
-    supabase.table("movimientos").insert(payload).execute()
-    invalidate_caches()
+    if idempotency_key:
+        payload["idempotency_key"] = idempotency_key
+    if subtipo:
+        payload["subtipo"] = subtipo
+    return payload
+
+def db_save_movs(movs: list) -> list:
+    """
+    Inserta muchos movimientos (payloads de mov_payload) en lotes e invalida una sola vez.
+    Con idempotency_key se hace upsert ignorando duplicados: lo ya cargado no se repite.
+    Devuelve las filas creadas.
+    """
+    creados = []
+    for i in range(0, len(movs), INSERT_BATCH):
+        lote = movs[i:i + INSERT_BATCH]
+        q = supabase.table("movimientos")
+        if any("idempotency_key" in m for m in lote):
+            q = q.upsert(lote, on_conflict="idempotency_key", ignore_duplicates=True)
+        else:
+            q = q.insert(lote)
+        creados += q.execute().data or []
+    if creados:
+        invalidate("movimientos", *[m["fecha"] for m in creados])
+    return creados
+
+def db_save_mov(fecha, monto, desc, cta_id, cat_id, tipo, dest_id=None, source="manual", raw_reference=None, merchant=None,
+                subtipo=None):
+    db_save_movs([mov_payload(fecha, monto, desc, cta_id, cat_id, tipo, dest_id=dest_id, source=source,
+                              raw_reference=raw_reference, merchant=merchant, subtipo=subtipo)])
+
+DELETE_BATCH = 200  # ids por request (el filtro in_ viaja en la URL)
+
+def db_delete_movs(ids: list) -> int:
+    """Borra muchos movimientos con un DELETE ... in_(id) por lote; una invalidación al final."""
+    borrados = []
+    for i in range(0, len(ids), DELETE_BATCH):
+        borrados += supabase.table("movimientos").delete().in_("id", ids[i:i + DELETE_BATCH]).execute().data or []
+    # el delete devuelve las filas borradas: invalidamos solo sus fechas
+    if borrados:
+        invalidate("movimientos", *[r["fecha"] for r in borrados])
+    return len(borrados)
 
 def db_delete_mov(id_mov):
-    supabase.table("movimientos").delete().eq("id", id_mov).execute()
-    invalidate_caches()
+    db_delete_movs([id_mov])
 
 def save_suscripcion(desc, monto, cta_id, cat_id, tipo):
     supabase.table("suscripciones").insert({
         "descripcion": desc, "monto": float(monto), "cuenta_id": cta_id, "categoria_id": cat_id, "tipo": tipo
     }).execute()
-    invalidate_caches()
+    invalidate("suscripciones")
 
 def delete_suscripcion(sid):
     supabase.table("suscripciones").delete().eq("id", sid).execute()
-    invalidate_caches()
+    invalidate("suscripciones")
 
 def save_meta(n, o, f):
     supabase.table("metas").insert({"nombre": n, "objetivo": float(o), "fecha_limite": str(f)}).execute()
-    invalidate_caches()
+    invalidate("metas")
 
 def update_meta_ahorro(mid, v):
     supabase.table("metas").update({"ahorrado": float(v)}).eq("id", mid).execute()
-    invalidate_caches()
+    invalidate("metas")
 
 def delete_meta(mid):
     supabase.table("metas").delete().eq("id", mid).execute()
-    invalidate_caches()
+    invalidate("metas")
 
-def db_save_compra_tarjeta(fecha_compra, monto_total, cuotas_total, cuenta_id, categoria_id, descripcion,
-                          source="manual", raw_reference=None, merchant=None):
-    # inserta compra
-    compra = supabase.table("compras_tarjeta").insert({
+def compra_payload(fecha_compra, monto_total, cuotas_total, cuenta_id, categoria_id, descripcion,
+                   source="manual", raw_reference=None, merchant=None, idempotency_key=None) -> dict:
+    payload = {
         "fecha_compra": str(fecha_compra),
         "monto_total": float(monto_total),
         "cuotas_total": int(cuotas_total),
@@ -364,27 +936,148 @@ def db_save_compra_tarjeta(fecha_compra, monto_total, cuotas_total, cuenta_id, c
         "source": source,
         "raw_reference": raw_reference,
         "merchant": merchant or descripcion
-    }).execute().data[0]
+    }
+    if idempotency_key:
+        payload["idempotency_key"] = idempotency_key
+    return payload
 
+def cuotas_payload(compra_id, compra: dict) -> list:
     # genera cuotas (virtuales / contables)
-    cuotas = []
-    monto_cuota = float(monto_total) / int(cuotas_total)
-    for i in range(int(cuotas_total)):
-        f_cuota = fecha_compra + relativedelta(months=i)
-        cuotas.append({
-            "compra_id": compra["id"],
-            "nro_cuota": i + 1,
-            "fecha_cuota": str(f_cuota),
-            "monto_cuota": float(monto_cuota),
-            "estado": "pendiente"
-        })
-    supabase.table("cuotas_tarjeta").insert(cuotas).execute()
-    invalidate_caches()
+    fecha_compra = date.fromisoformat(str(compra["fecha_compra"])[:10])
+    cuotas_total = int(compra["cuotas_total"])
+    monto_cuota = float(compra["monto_total"]) / cuotas_total
+    return [{
+        "compra_id": compra_id,
+        "nro_cuota": i + 1,
+        "fecha_cuota": str(fecha_compra + relativedelta(months=i)),
+        "monto_cuota": float(monto_cuota),
+        "estado": "pendiente"
+    } for i in range(cuotas_total)]
+
+@st.cache_resource
+def _rpc_state() -> dict:
+    # False si la función crear_compras_tarjeta / borrar_compras_tarjeta no existe (migración sin aplicar)
+    return {"compras": True, "borrar": True}
+
+def _insert_compras_legacy(lote: list) -> list:
+    # dos pasos (compras, después cuotas): sólo si falta la RPC
+    q = supabase.table("compras_tarjeta")
+    if any("idempotency_key" in c for c in lote):
+        q = q.upsert(lote, on_conflict="idempotency_key", ignore_duplicates=True)
+    else:
+        q = q.insert(lote)
+    data = q.execute().data or []
+    # cuotas sólo de las compras realmente creadas (con idempotency_key las repetidas no vuelven)
+    cuotas = [q for row in data for q in cuotas_payload(row["id"], row)]
+    for i in range(0, len(cuotas), INSERT_BATCH):
+        supabase.table("cuotas_tarjeta").insert(cuotas[i:i + INSERT_BATCH]).execute()
+    return data
+
+class PartialSaveError(Exception):
+    """Falló un lote después de que otros ya quedaron guardados; `creadas` son las filas ya escritas."""
+    def __init__(self, msg: str, creadas: list):
+        super().__init__(msg)
+        self.creadas = creadas
+
+def db_save_compras_tarjeta(compras: list) -> list:
+    """
+    Alta de muchas compras (payloads de compra_payload) con sus cuotas vía la RPC
+    crear_compras_tarjeta: un request atómico por lote de INSERT_BATCH compras.
+    Invalida una sola vez al final. Devuelve las compras creadas; si un lote falla,
+    levanta PartialSaveError con las de los lotes anteriores (ya guardadas e invalidadas).
+    """
+    rpc = _rpc_state()
+    creadas = []
+    try:
+        for i in range(0, len(compras), INSERT_BATCH):
+            lote = compras[i:i + INSERT_BATCH]
+            if rpc["compras"]:
+                try:
+                    creadas += supabase.rpc("crear_compras_tarjeta", {"p_compras": lote}).execute().data or []
+                    continue
+                except Exception as e:
+                    # sólo se cae a dos pasos si la función no existe (PGRST202); otros errores se propagan
+                    if "PGRST202" not in str(e) and "Could not find the function" not in str(e):
+                        raise
+                    rpc["compras"] = False
+            creadas += _insert_compras_legacy(lote)
+    except Exception as e:
+        raise PartialSaveError(str(e), creadas) from e
+    finally:
+        if creadas:
+            invalidate("compras_tarjeta", *[c["fecha_compra"] for c in creadas])
+            invalidate("cuotas_tarjeta", *[q["fecha_cuota"] for c in creadas for q in cuotas_payload(None, c)])
+    return creadas
+
+def db_save_compra_tarjeta(fecha_compra, monto_total, cuotas_total, cuenta_id, categoria_id, descripcion,
+                          source="manual", raw_reference=None, merchant=None):
+    db_save_compras_tarjeta([compra_payload(
+        fecha_compra, monto_total, cuotas_total, cuenta_id, categoria_id, descripcion,
+        source=source, raw_reference=raw_reference, merchant=merchant
+    )])
+
+def db_delete_compras_tarjeta(ids: list) -> int:
+    """
+    Borra muchas compras y sus cuotas vía la RPC borrar_compras_tarjeta: un request atómico
+    por lote de DELETE_BATCH compras (nunca quedan compras sin cuotas o al revés).
+    Las fechas de cuotas a invalidar salen de las compras borradas, como en el alta.
+    """
+    rpc = _rpc_state()
+    borradas = []
+    try:
+        for i in range(0, len(ids), DELETE_BATCH):
+            lote = ids[i:i + DELETE_BATCH]
+            if rpc["borrar"]:
+                try:
+                    borradas += supabase.rpc("borrar_compras_tarjeta", {"p_compras": [{"id": x} for x in lote]}).execute().data or []
+                    continue
+                except Exception as e:
+                    # sólo se cae a dos pasos si la función no existe (PGRST202); otros errores se propagan
+                    if "PGRST202" not in str(e) and "Could not find the function" not in str(e):
+                        raise
+                    rpc["borrar"] = False
+            supabase.table("cuotas_tarjeta").delete().in_("compra_id", lote).execute()
+            borradas += supabase.table("compras_tarjeta").delete().in_("id", lote).execute().data or []
+    finally:
+        if borradas:
+            invalidate("compras_tarjeta", *[r["fecha_compra"] for r in borradas])
+            invalidate("cuotas_tarjeta", *[q["fecha_cuota"] for c in borradas for q in cuotas_payload(None, c)])
+    return len(borradas)
 
 def db_delete_compra_tarjeta(compra_id):
-    # cascada borra cuotas por FK on delete cascade (si lo creaste así)
-    supabase.table("compras_tarjeta").delete().eq("id", compra_id).execute()
-    invalidate_caches()
+    db_delete_compras_tarjeta([compra_id])
+
+def _like_prefix(prefix: str) -> str:
+    # el nombre de archivo va literal
+    return like_escape(prefix) + "%"
+
+def ids_by_reference(tabla: str, prefix: str) -> list:
+    """ids cuyo raw_reference empieza con `prefix` (ej. "resumen.xlsx:" = todo ese import)."""
+    ids, start = [], 0
+    while True:
+        rows = (
+            supabase.table(tabla).select("id").like("raw_reference", _like_prefix(prefix))
+            .order("id").range(start, start + MIRROR_PAGE - 1).execute()
+        ).data or []
+        ids += [r["id"] for r in rows]
+        if len(rows) < MIRROR_PAGE:
+            return ids
+        start += MIRROR_PAGE
+
+def count_by_reference(tabla: str, prefix: str) -> int:
+    """Cantidad de filas con raw_reference que empieza con `prefix` (count exacto, sin bajar ids)."""
+    resp = (
+        supabase.table(tabla).select("id", count="exact").like("raw_reference", _like_prefix(prefix))
+        .limit(1).execute()
+    )
+    return int(resp.count or 0)
+
+def db_delete_by_reference(prefix: str) -> dict:
+    """Deshace una importación: movimientos y compras (con cuotas) cuyo raw_reference empieza con prefix."""
+    return {
+        "movimientos": db_delete_movs(ids_by_reference("movimientos", prefix)),
+        "compras_tarjeta": db_delete_compras_tarjeta(ids_by_reference("compras_tarjeta", prefix)),
+    }
 
 def log_import_error(source: str, message: str, raw_payload: dict | None):
     try:
@@ -396,34 +1089,194 @@ def log_import_error(source: str, message: str, raw_payload: dict | None):
     except Exception:
         pass
 
+def import_compras_tarjeta(df_u: pd.DataFrame, fc, dc, mc, tid, df_cat: pd.DataFrame, file_name: str) -> dict:
+    """
+    Importación masiva de un resumen de tarjeta:
+      1) parsea todas las filas
+      2) trae las compras existentes de la tarjeta en el rango de fechas del archivo (una consulta)
+      3) deduplica contra ese set en memoria (también dentro del mismo archivo)
+      4) inserta compras + cuotas en lotes, con una sola invalidación
+    """
+    t0 = time.perf_counter()
+    cat_by_name = {str(n): str(i) for n, i in zip(df_cat["nombre"], df_cat["id"])} if not df_cat.empty else {}
+    cat_default_name = "General" if "General" in cat_by_name else (df_cat.iloc[0]["nombre"] if not df_cat.empty else "General")
+    cat_default_id = cat_by_name.get(cat_default_name)
+
+    errors = 0
+    parsed = []
+    for idx, f_raw, d_raw, m_raw in zip(df_u.index, df_u[fc], df_u[dc], df_u[mc]):
+        try:
+            desc = str(d_raw).strip() if not pd.isna(d_raw) else ""
+            if not desc or desc.lower() == "nan":
+                continue
+            val = parse_amount(m_raw)
+            fval = pd.to_datetime(f_raw, dayfirst=True, errors="coerce")
+            if pd.isna(fval):
+                continue
+            parsed.append((idx, fval.date(), val, desc))
+        except Exception as e:
+            errors += 1
+            log_import_error("excel", f"Row {idx}: {e}", {"row": int(idx), "detalle": str(df_u.loc[idx].to_dict())})
+
+    # categorías de todo el archivo en una pasada
+    if parsed:
+        cats = CategoryEngine(df_cat).classify(pd.Series([p[3] for p in parsed]))
+        parsed = [(*p, cat_by_name.get(c, cat_default_id)) for p, c in zip(parsed, cats)]
+
+    # dedupe: claves existentes de esta tarjeta en el rango del archivo
+    existing = set()
+    if parsed:
+        f_min = min(p[1] for p in parsed)
+        f_max = max(p[1] for p in parsed)
+        start = 0
+        while True:
+            rows = (
+                supabase.table("compras_tarjeta")
+                .select("fecha_compra, monto_total, descripcion")
+                .eq("cuenta_id", str(tid))
+                .gte("fecha_compra", str(f_min))
+                .lte("fecha_compra", str(f_max))
+                .range(start, start + MIRROR_PAGE - 1)
+                .execute()
+            ).data or []
+            existing.update((str(r["fecha_compra"]), round(float(r["monto_total"]), 2), r["descripcion"]) for r in rows)
+            if len(rows) < MIRROR_PAGE:
+                break
+            start += MIRROR_PAGE
+
+    skipped = 0
+    nuevas = []
+    for idx, fval, val, desc, cat_id in parsed:
+        key = (str(fval), round(float(val), 2), desc)
+        if key in existing:
+            skipped += 1
+            continue
+        existing.add(key)
+        # inserta como compra de 1 cuota
+        nuevas.append(compra_payload(fval, val, 1, tid, cat_id, desc, source="excel",
+                                     raw_reference=f"{file_name}:row{idx}", merchant=desc))
+
+    inserted = 0
+    try:
+        inserted = len(db_save_compras_tarjeta(nuevas)) if nuevas else 0
+    except PartialSaveError as e:
+        # los lotes previos al error quedaron guardados
+        inserted = len(e.creadas)
+        errors += len(nuevas) - inserted
+        log_import_error("excel", f"Bulk insert: {e}", {"file": file_name, "rows": len(nuevas), "inserted": inserted})
+
+    return {
+        "inserted": inserted,
+        "skipped": skipped,
+        "errors": errors,
+        "rows": len(df_u),
+        "seconds": time.perf_counter() - t0,
+    }
+
 # =========================================================
 # 8) CICLOS TARJETA
 # =========================================================
-def last_cierre_date(today: date, dia_cierre: int) -> date:
-    cierre_this = safe_date(today.year, today.month, dia_cierre)
-    if today > cierre_this:
-        return cierre_this
-    prev = today - relativedelta(months=1)
-    return safe_date(prev.year, prev.month, dia_cierre)
-
-def prev_cierre_date(cierre: date, dia_cierre: int) -> date:
-    prev = cierre - relativedelta(months=1)
-    return safe_date(prev.year, prev.month, dia_cierre)
-
-def next_cierre_date(today: date, dia_cierre: int) -> date:
-    cierre_this = safe_date(today.year, today.month, dia_cierre)
-    if today <= cierre_this:
-        return cierre_this
-    nxt = today + relativedelta(months=1)
-    return safe_date(nxt.year, nxt.month, dia_cierre)
-
-def due_date_from_cierre(cierre: date, dia_vto: int) -> date:
-    nxt = cierre + relativedelta(months=1)
-    return safe_date(nxt.year, nxt.month, dia_vto)
+CYCLE_YEARS = (2000, 2100)  # ventana precalculada de cada calendario de tarjeta
+
+class CardCycle:
+    """
+    Calendario de ciclos de una tarjeta: todos los cierres (y su vto) de CYCLE_YEARS
+    se calculan una sola vez. "¿A qué resumen pertenece esta fecha?" es una búsqueda
+    binaria, también sobre un array entero de fechas.
+    """
+    def __init__(self, dia_cierre: int, dia_vto: int):
+        meses = [date(y, m, 1) for y in range(CYCLE_YEARS[0], CYCLE_YEARS[1] + 1) for m in range(1, 13)]
+        self.cierres = np.array([safe_date(m.year, m.month, dia_cierre) for m in meses], dtype="datetime64[D]")
+        # el vto de un cierre cae el mes siguiente
+        nxt = [m + relativedelta(months=1) for m in meses]
+        self.vtos = np.array([safe_date(m.year, m.month, dia_vto) for m in nxt], dtype="datetime64[D]")
+
+    def statement_of(self, fechas) -> np.ndarray:
+        """Índice del cierre de cada fecha: cierres[i-1] < fecha <= cierres[i]."""
+        return np.searchsorted(self.cierres, np.asarray(fechas, dtype="datetime64[D]"), side="left")
+
+    def last_index(self, ref: date) -> int:
+        """Índice del último cierre estrictamente anterior a ref (el siguiente es last_index + 1)."""
+        return int(self.statement_of([ref])[0]) - 1
+
+    def cierre(self, i: int) -> date:
+        return self.cierres[i].item()
+
+    def vto(self, i: int) -> date:
+        return self.vtos[i].item()
+
+@st.cache_resource
+def card_cycle(dia_cierre: int, dia_vto: int) -> CardCycle:
+    return CardCycle(dia_cierre, dia_vto)
 
 def resumen_key_from_cierre(card_name: str, cierre: date) -> str:
     return f"{card_name} {cierre.year}-{cierre.month:02d}"
 
+# ---------------------------------------------------------
+# Consumos de tarjeta: cada cuota viene con su compra (select embebido / join local)
+# ---------------------------------------------------------
+INSTALLMENT_PARENT_COLS = ("cuenta_id", "categoria_id", "source", "raw_reference", "descripcion")
+PARENT_CHUNK = 150
+FETCH_WORKERS = 4
+
+def _parallel(fn, items: list) -> list:
+    """fn sobre cada item con requests concurrentes; respeta el orden de items."""
+    if len(items) <= 1:
+        return [fn(x) for x in items]
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+def _cuotas_con_compra_remote(desde: date, hasta: date) -> list:
+    cols = ", ".join(INSTALLMENT_PARENT_COLS)
+
+    def page(start: int, count=None):
+        return (
+            supabase.table("cuotas_tarjeta")
+            .select(f"*, compras_tarjeta({cols})", count=count)
+            .gte("fecha_cuota", str(desde))
+            .lte("fecha_cuota", str(hasta))
+            .order("fecha_cuota")
+            .order("id")
+            .range(start, start + MIRROR_PAGE - 1)
+            .execute()
+        )
+
+    try:
+        first = page(0, count="exact")
+        rows = first.data or []
+        total = getattr(first, "count", None)
+        if total is None:
+            total = len(rows)
+        # el resto de las páginas (si hay) en paralelo
+        rows += sum(_parallel(lambda s: page(s).data or [], list(range(MIRROR_PAGE, total, MIRROR_PAGE))), [])
+        return rows
+    except Exception as e:
+        # sólo sin relación cuotas→compras expuesta (PGRST200); timeouts y 5xx se propagan
+        if "PGRST200" not in str(e):
+            raise
+        # compras por id, en chunks concurrentes
+        rows = _load_cuotas_tarjeta(desde, hasta).to_dict("records")
+        ids = list({str(r["compra_id"]) for r in rows})
+        chunks = [ids[i:i+PARENT_CHUNK] for i in range(0, len(ids), PARENT_CHUNK)]
+        padres = sum(_parallel(
+            lambda ch: supabase.table("compras_tarjeta").select(f"id, {cols}").in_("id", ch).execute().data or [],
+            chunks,
+        ), [])
+        by_id = {str(p["id"]): p for p in padres}
+        for r in rows:
+            r["compras_tarjeta"] = by_id.get(str(r["compra_id"]))
+        return rows
+
+def _cuotas_con_compra(desde: date, hasta: date) -> list:
+    log_fetch("descargas", "cuotas + compras")
+    rows = mirror_rows("cuotas_tarjeta", desde, hasta)
+    if rows is None:
+        return _cuotas_con_compra_remote(desde, hasta)
+    by_id = {str(p["id"]): p for p in mirror.read_ids("compras_tarjeta", {str(r["compra_id"]) for r in rows})}
+    for r in rows:
+        r["compras_tarjeta"] = by_id.get(str(r["compra_id"]))
+    return rows
+
 def get_tarjeta_installments(df_cta, df_cat, desde: date, hasta: date) -> pd.DataFrame:
     """
     Unifica consumos tarjeta:
@@ -431,40 +1284,43 @@ def get_tarjeta_installments(df_cta, df_cat, desde: date, hasta: date) -> pd.Dat
       - movimientos tipo COMPRA_TARJETA (viejo/imports viejos)
     Devuelve columnas: fecha, monto, cuenta_id, cuenta, categoria, source, raw_reference
     """
-    # cuotas nuevas
-    df_q = get_cuotas_tarjeta(desde, hasta)
+    log_fetch("llamadas", "consumos tarjeta")
+    # las compras madre de cuotas en [desde, hasta] son de fechas <= hasta
+    version = (
+        window_version("cuotas_tarjeta", desde, hasta),
+        window_version("compras_tarjeta", date.min, hasta),
+        window_version("movimientos", desde, hasta),
+        table_version("cuentas"),
+        table_version("categorias"),
+    )
+    return _fetch_tarjeta_installments(desde, hasta, version, df_cta, df_cat)
+
+@st.cache_data(ttl=45, show_spinner=False)
+def _fetch_tarjeta_installments(desde: date, hasta: date, version: tuple, _df_cta, _df_cat) -> pd.DataFrame:
+    df_cta, df_cat = _df_cta, _df_cat
     df_out = []
 
-    if not df_q.empty:
-        compra_ids = df_q["compra_id"].unique().tolist()
-        # traemos compras asociadas (en batches por si son muchas)
-        df_p_all = []
-        chunk = 150
-        for i in range(0, len(compra_ids), chunk):
-            ids = compra_ids[i:i+chunk]
-            resp = supabase.table("compras_tarjeta").select("*").in_("id", ids).execute()
-            df_p_all.append(pd.DataFrame(resp.data or []))
-        df_p = pd.concat(df_p_all, ignore_index=True) if df_p_all else pd.DataFrame()
-
-        if not df_p.empty:
-            df_p["id"] = df_p["id"].astype(str)
-            df_q["compra_id"] = df_q["compra_id"].astype(str)
-            m = df_q.merge(df_p, left_on="compra_id", right_on="id", how="left", suffixes=("_cuota", "_compra"))
-            # map nombres
-            cta_map = dict(zip(df_cta["id"].astype(str), df_cta["nombre"].astype(str))) if not df_cta.empty else {}
-            cat_map = dict(zip(df_cat["id"].astype(str), (df_cat["icono"].fillna("") + " " + df_cat["nombre"]).str.strip())) if not df_cat.empty else {}
-
-            m["fecha"] = m["fecha_cuota"]
-            m["monto"] = m["monto_cuota"]
-            m["cuenta_id"] = m["cuenta_id"].astype(str)
-            m["cuenta"] = m["cuenta_id"].map(cta_map).fillna("Tarjeta")
-            m["categoria_id"] = m["categoria_id"].astype(str)
-            m["categoria"] = m["categoria_id"].map(cat_map).fillna("General")
-            m["source"] = m.get("source", "manual")
-            m["raw_reference"] = m.get("raw_reference", None)
-            m["descripcion"] = m.get("descripcion", "")
-
-            df_out.append(m[["fecha", "monto", "cuenta_id", "cuenta", "categoria", "source", "raw_reference", "descripcion"]])
+    # cuotas nuevas
+    rows = _cuotas_con_compra(desde, hasta)
+    if rows:
+        padres = [r.pop("compras_tarjeta", None) or {} for r in rows]
+        m = pd.DataFrame(rows)
+        for c in INSTALLMENT_PARENT_COLS:
+            m[c] = pd.Series([p.get(c) for p in padres], dtype=object)
+        # map nombres
+        cta_map = dict(zip(df_cta["id"].astype(str), df_cta["nombre"].astype(str))) if not df_cta.empty else {}
+        cat_map = dict(zip(df_cat["id"].astype(str), (df_cat["icono"].fillna("") + " " + df_cat["nombre"]).str.strip())) if not df_cat.empty else {}
+
+        m["fecha"] = m["fecha_cuota"]
+        m["monto"] = m["monto_cuota"]
+        m["cuenta_id"] = m["cuenta_id"].astype(str)
+        m["cuenta"] = m["cuenta_id"].map(cta_map).fillna("Tarjeta")
+        m["categoria_id"] = m["categoria_id"].astype(str)
+        m["categoria"] = m["categoria_id"].map(cat_map).fillna("General")
+        m["source"] = m["source"].fillna("manual")
+        m["descripcion"] = m["descripcion"].fillna("")
+
+        df_out.append(m[["fecha", "monto", "cuenta_id", "cuenta", "categoria", "source", "raw_reference", "descripcion"]])
 
     # consumos viejos en movimientos
     df_m = get_movimientos(desde, hasta, back_months=0)
@@ -487,6 +1343,111 @@ def get_tarjeta_installments(df_cta, df_cat, desde: date, hasta: date) -> pd.Dat
     out["monto"] = pd.to_numeric(out["monto"], errors="coerce").fillna(0.0)
     return out
 
+def card_statements(df_cards: pd.DataFrame, df_tj: pd.DataFrame, df_mov: pd.DataFrame, ref: date):
+    """
+    Motor de resúmenes para todas las tarjetas a la fecha `ref`, en una pasada:
+      - etiqueta cada consumo con su periodo ("stmt": último resumen cerrado, "open": en curso)
+      - etiqueta cada PAGO_TARJETA aplicado a ese resumen (cierre → vto)
+      - stmt_total / open_total / pagos / saldo_pend por tarjeta con un groupby
+    Devuelve (estado por tarjeta, en el orden de df_cards; consumos etiquetados; pagos etiquetados).
+    """
+    dias_c = [int(d or 25) for d in df_cards["dia_cierre"].fillna(0)]
+    dias_v = [int(d or 5) for d in df_cards["dia_vencimiento"].fillna(0)]
+    cycles = [card_cycle(c, v) for c, v in zip(dias_c, dias_v)]
+    ks = [cyc.last_index(ref) for cyc in cycles]
+
+    est = pd.DataFrame({"cuenta_id": df_cards["id"].astype(str).values})
+    est["cierre"] = [cyc.cierre(k) for cyc, k in zip(cycles, ks)]
+    est["prev"] = [cyc.cierre(k - 1) for cyc, k in zip(cycles, ks)]
+    est["vto"] = [cyc.vto(k) for cyc, k in zip(cycles, ks)]
+    est["next_cierre"] = [cyc.cierre(k + 1) for cyc, k in zip(cycles, ks)]
+    est["stmt_start"] = [p + timedelta(days=1) for p in est["prev"]]
+    est["open_start"] = [c + timedelta(days=1) for c in est["cierre"]]
+
+    # periodos como datetime64 para comparar columnas enteras
+    periodos = pd.DataFrame({
+        "_card": est["cuenta_id"],
+        "_cierre": pd.to_datetime(est["cierre"]),
+        "_vto": pd.to_datetime(est["vto"]),
+    })
+    cycle_by_card = dict(zip(est["cuenta_id"], cycles))
+    k_by_card = dict(zip(est["cuenta_id"], ks))
+    ref64 = pd.Timestamp(ref)
+
+    tj = df_tj.assign(_card=df_tj["cuenta_id"].astype(str), _f=pd.to_datetime(df_tj["fecha"])) if not df_tj.empty else pd.DataFrame(columns=["_card", "_f", "monto"])
+    tj = tj.merge(periodos, on="_card", how="inner")
+    # índice de resumen de cada consumo: un searchsorted por tarjeta sobre todas sus fechas
+    stmt_idx = np.full(len(tj), -1)
+    for card, pos in tj.groupby("_card").indices.items():
+        stmt_idx[pos] = cycle_by_card[card].statement_of(tj["_f"].values[pos])
+    k_last = tj["_card"].map(k_by_card).to_numpy()
+    tj["periodo"] = np.select(
+        [stmt_idx == k_last,
+         (stmt_idx == k_last + 1) & (tj["_f"] <= ref64).to_numpy()],
+        ["stmt", "open"],
+        default="",
+    )
+    tj = tj[tj["periodo"] != ""]
+    tot = tj.groupby(["_card", "periodo"])["monto"].sum().unstack(fill_value=0.0)
+    for periodo, col in (("stmt", "stmt_total"), ("open", "open_total")):
+        serie = tot[periodo] if periodo in tot.columns else pd.Series(dtype=float)
+        est[col] = est["cuenta_id"].map(serie).fillna(0.0).astype(float)
+
+    pg = pd.DataFrame(columns=["_card", "_f", "monto"])
+    if not df_mov.empty:
+        pg = df_mov[df_mov["tipo"] == "PAGO_TARJETA"]
+        pg = pg.assign(_card=pg["cuenta_destino_id"].astype(str), _f=pd.to_datetime(pg["fecha"]))
+    pg = pg.merge(periodos, on="_card", how="inner")
+    pg = pg[(pg["_f"] >= pg["_cierre"]) & (pg["_f"] <= pg["_vto"])]
+    est["pagos"] = est["cuenta_id"].map(pg.groupby("_card")["monto"].sum()).fillna(0.0).astype(float)
+    est["saldo_pend"] = (est["stmt_total"] - est["pagos"]).clip(lower=0.0)
+
+    helpers = ["_f", "_cierre", "_vto"]
+    return est, tj.drop(columns=helpers), pg.drop(columns=helpers)
+
+class RenderData:
+    """
+    Datos de una página en un render: movimientos y consumos de tarjeta de la ventana más
+    amplia que se necesita, leídos una sola vez. Los subrangos (mes, resúmenes) se cortan en memoria.
+    """
+    def __init__(self, df_cta, df_cat, desde: date, hasta: date):
+        self.df_cta, self.df_cat = df_cta, df_cat
+        self.desde, self.hasta = desde, hasta
+        self._mov = None
+        self._tj = None
+
+    def _slice(self, df: pd.DataFrame, desde, hasta) -> pd.DataFrame:
+        desde, hasta = desde or self.desde, hasta or self.hasta
+        if desde < self.desde or hasta > self.hasta:
+            raise ValueError(f"{desde}..{hasta} fuera de la ventana cargada {self.desde}..{self.hasta}")
+        if df.empty or (desde == self.desde and hasta == self.hasta):
+            return df
+        return df[(df["fecha"] >= desde) & (df["fecha"] <= hasta)].reset_index(drop=True)
+
+    def movimientos(self, desde: date = None, hasta: date = None) -> pd.DataFrame:
+        if self._mov is None:
+            self._mov = get_movimientos(self.desde, self.hasta)
+        return self._slice(self._mov, desde, hasta)
+
+    def tarjeta(self, desde: date = None, hasta: date = None) -> pd.DataFrame:
+        if self._tj is None:
+            self._tj = get_tarjeta_installments(self.df_cta, self.df_cat, self.desde, self.hasta)
+        return self._slice(self._tj, desde, hasta)
+
+def fetch_debug_panel():
+    """Expander con las lecturas del render (llamadas de la página vs. descargas reales)."""
+    with st.expander("🔧 Debug: lecturas de datos", expanded=False):
+        nombres = sorted(set(FETCH_LOG["llamadas"]) | set(FETCH_LOG["descargas"]))
+        if not nombres:
+            st.caption("Sin lecturas en este render.")
+            return
+        st.dataframe(pd.DataFrame({
+            "lectura": nombres,
+            "llamadas": [FETCH_LOG["llamadas"].get(n, 0) for n in nombres],
+            "descargas": [FETCH_LOG["descargas"].get(n, 0) for n in nombres],
+        }), hide_index=True, use_container_width=True)
+        st.caption("Descargas = cache miss (base o espejo local); el resto se sirvió desde cache.")
+
 # =========================================================
 # 9) CARGA MAESTROS
 # =========================================================
@@ -515,11 +1476,16 @@ with st.sidebar:
 if menu == "📊 Dashboard":
     st.markdown(f"## 📈 Balance: {month_name_es(f_ini.month).title()} {f_ini.year}")
 
+    # ventana única del render: con tarjetas, 2 meses antes para los resúmenes
+    df_cards = df_cta[df_cta["tipo"] == "CREDITO"].copy() if not df_cta.empty else pd.DataFrame()
+    from_x = f_ini - relativedelta(months=2) if not df_cards.empty else f_ini
+    datos = RenderData(df_cta, df_cat, from_x, f_fin)
+
     # movimientos cash / ingresos / pagos
-    df_raw = get_movimientos(f_ini, f_fin, back_months=0)
+    df_raw = datos.movimientos(f_ini, f_fin)
 
     # consumos tarjeta (cuotas + viejos)
-    df_tj_mes = get_tarjeta_installments(df_cta, df_cat, f_ini, f_fin)
+    df_tj_mes = datos.tarjeta(f_ini, f_fin)
 
     if (df_raw.empty) and (df_tj_mes.empty):
         st.warning("No hay datos en este mes.")
@@ -547,41 +1513,16 @@ if menu == "📊 Dashboard":
         # "Pagar resumen" (estimación): sumatoria de saldos pendientes por tarjeta con vto en este mes
         hoy = date.today()
         pagar_resumen_mes = 0.0
-        if not df_cta.empty:
-            df_cards = df_cta[df_cta["tipo"] == "CREDITO"].copy()
-            if not df_cards.empty:
-                # consumos necesarios para calcular statement (traemos 2 meses)
-                from_x = f_ini - relativedelta(months=2)
-                to_x = f_fin
-                df_tj_ext = get_tarjeta_installments(df_cta, df_cat, from_x, to_x)
-                df_mov_ext = get_movimientos(from_x, to_x, back_months=0)
-
-                for _, card in df_cards.iterrows():
-                    dia_cierre = int(card.get("dia_cierre") or 25)
-                    dia_vto = int(card.get("dia_vencimiento") or 5)
-
-                    # statements cuyo vto cae entre f_ini..f_fin:
-                    # aproximación: tomamos el último cierre previo al fin de mes y vemos su vto
-                    cierre = last_cierre_date(f_fin, dia_cierre)
-                    vto = due_date_from_cierre(cierre, dia_vto)
-                    # si vto cae en este mes, calculamos saldo pendiente de ese cierre
-                    if f_ini <= vto <= f_fin:
-                        prev = prev_cierre_date(cierre, dia_cierre)
-                        stmt_start = prev + timedelta(days=1)
-                        stmt_end = cierre
-                        card_id = str(card["id"])
-
-                        stmt_total = df_tj_ext[(df_tj_ext["cuenta_id"] == card_id) &
-                                                (df_tj_ext["fecha"] >= stmt_start) &
-                                                (df_tj_ext["fecha"] <= stmt_end)]["monto"].sum()
-
-                        pagos = 0.0
-                        if not df_mov_ext.empty:
-                            pagos = df_mov_ext[(df_mov_ext["tipo"] == "PAGO_TARJETA") &
-                                                (df_mov_ext["cuenta_destino_id"].astype(str) == card_id) &
-                                                (df_mov_ext["fecha"] >= cierre) &
-                                                (df_mov_ext["fecha"] <= vto)]["monto"].sum()
-                        pagar_resumen_mes += max(stmt_total - pagos, 0.0)
+        if not df_cards.empty:
+            # consumos necesarios para calcular statement (la ventana ya trae 2 meses)
+            df_tj_ext = datos.tarjeta()
+            df_mov_ext = datos.movimientos()
+
+            # statements cuyo vto cae entre f_ini..f_fin:
+            # aproximación: tomamos el último cierre previo al fin de mes y vemos su vto
+            est, _, _ = card_statements(df_cards, df_tj_ext, df_mov_ext, f_fin)
+            est_mes = est[(est["vto"] >= f_ini) & (est["vto"] <= f_fin)]
+            pagar_resumen_mes = float(est_mes["saldo_pend"].sum())
 
         caja_real = total_ingresos - gastos_cash - pagar_resumen_mes
 
@@ -672,6 +1613,9 @@ if menu == "📊 Dashboard":
             if idx == 0:
                 st.caption("No hay presupuestos definidos. Ve a Ajustes para configurarlos.")
 
+    st.divider()
+    fetch_debug_panel()
+
 # =========================================================
 # 12) CALENDARIO
 # =========================================================
@@ -696,39 +1640,45 @@ elif menu == "📅 Calendario":
         df_cal["fecha"] = pd.to_datetime(df_cal["fecha"]).dt.date
         df_cal["monto"] = pd.to_numeric(df_cal["monto"], errors="coerce").fillna(0.0)
 
+    # totales y eventos por día en una sola pasada
+    tot_dia, evs_dia = {}, {}
+    if not df_cal.empty:
+        df_cal["es_ing"] = df_cal["tipo"] == "INGRESO"
+        tot_dia = df_cal.groupby(["fecha", "es_ing"])["monto"].sum().unstack(fill_value=0.0).to_dict("index")
+        evs_dia = {f: g for f, g in df_cal.groupby("fecha")}
+
     cal = calendar.Calendar()
     semanas = cal.monthdayscalendar(int(anio_sel), int(mes_sel))
     dias = ["Lun", "Mar", "Mié", "Jue", "Vie", "Sáb", "Dom"]
 
-    cols = st.columns(7)
-    for i, d in enumerate(dias):
-        cols[i].markdown(f"<div style='text-align:center; font-weight:600; opacity:0.7;'>{d}</div>", unsafe_allow_html=True)
-
+    # todo el mes como una sola grilla HTML (un único elemento por rerun)
+    cells = [f"<div class='cal-head'>{d}</div>" for d in dias]
     for semana in semanas:
-        cols = st.columns(7)
-        for i, dia in enumerate(semana):
-            with cols[i]:
-                if dia != 0:
-                    fecha_dia = date(int(anio_sel), int(mes_sel), int(dia))
-                    content_html = f"<div class='day-header'>{dia}</div>"
-                    evs = df_cal[df_cal["fecha"] == fecha_dia] if not df_cal.empty else pd.DataFrame()
-
-                    ing = evs[evs["tipo"] == "INGRESO"]["monto"].sum() if not evs.empty else 0
-                    gas = evs[evs["tipo"] != "INGRESO"]["monto"].sum() if not evs.empty else 0
-
-                    if ing > 0:
-                        content_html += f"<div class='tag-ing'>+{fmt_ars(ing)}</div>"
-                    if gas > 0:
-                        content_html += f"<div class='tag-gas'>-{fmt_ars(gas)}</div>"
-
-                    st.markdown(f"<div class='day-card'>{content_html}</div>", unsafe_allow_html=True)
-
-                    if not evs.empty:
-                        with st.popover("Ver", use_container_width=True):
-                            st.caption(f"{dia}/{mes_sel}/{anio_sel}")
-                            st.dataframe(evs[["descripcion", "tipo", "monto"]], hide_index=True, use_container_width=True)
-                else:
-                    st.write("")
+        for dia in semana:
+            if dia == 0:
+                cells.append("<div></div>")
+                continue
+            fecha_dia = date(int(anio_sel), int(mes_sel), int(dia))
+            content_html = f"<div class='day-header'>{dia}</div>"
+            tot = tot_dia.get(fecha_dia, {})
+            ing = tot.get(True, 0.0)
+            gas = tot.get(False, 0.0)
+            if ing > 0:
+                content_html += f"<div class='tag-ing'>+{fmt_ars(ing)}</div>"
+            if gas > 0:
+                content_html += f"<div class='tag-gas'>-{fmt_ars(gas)}</div>"
+
+            evs = evs_dia.get(fecha_dia)
+            if evs is not None:
+                filas = "".join(
+                    f"<tr><td>{html.escape(str(d_))}</td><td>{html.escape(str(t_))}</td><td>{fmt_ars(m_)}</td></tr>"
+                    for d_, t_, m_ in zip(evs["descripcion"], evs["tipo"], evs["monto"])
+                )
+                content_html += f"<details class='day-evs'><summary>Ver ({len(evs)})</summary><table>{filas}</table></details>"
+
+            cells.append(f"<div class='day-card'>{content_html}</div>")
+
+    st.markdown(f"<div class='cal-grid'>{''.join(cells)}</div>", unsafe_allow_html=True)
 
 # =========================================================
 # 13) NUEVA OPERACIÓN
@@ -824,33 +1774,32 @@ elif menu == "➕ Nueva Operación":
             )
 
             if st.button("🚀 Procesar", type="primary"):
-                c = 0
+                # arma todo primero y escribe en bloque; la clave por (suscripción, mes)
+                # evita duplicar si se aprieta dos veces o se reprocesa el mes
+                mes_key = fecha_imp.strftime("%Y-%m")
+                movs, compras = [], []
                 for i, row in ed_sus.iterrows():
                     if i in df_sus.index:
                         orig = df_sus.loc[i]
                         # si la suscripción es tarjeta, lo dejamos como compra de 1 cuota
                         cuenta_id = orig["cuenta_id"]
                         tipo = str(orig.get("tipo") or "GASTO")
+                        key = f"fijo:{orig['id']}:{mes_key}"
                         if tipo == "COMPRA_TARJETA":
-                            db_save_compra_tarjeta(
-                                fecha_compra=fecha_imp,
-                                monto_total=row["monto"],
-                                cuotas_total=1,
-                                cuenta_id=cuenta_id,
-                                categoria_id=orig["categoria_id"],
-                                descripcion=row["descripcion"],
-                                source="fijo",
-                                raw_reference=None,
-                                merchant=row["descripcion"]
-                            )
+                            compras.append(compra_payload(
+                                fecha_imp, row["monto"], 1, cuenta_id, orig["categoria_id"], row["descripcion"],
+                                source="fijo", merchant=row["descripcion"], idempotency_key=key
+                            ))
                         else:
-                            db_save_mov(
+                            movs.append(mov_payload(
                                 fecha_imp, row["monto"], row["descripcion"],
                                 cuenta_id, orig["categoria_id"], tipo,
-                                source="fijo"
-                            )
-                        c += 1
-                st.toast(f"✅ {c} movimientos procesados")
+                                source="fijo", idempotency_key=key
+                            ))
+                c = len(db_save_movs(movs)) if movs else 0
+                c += len(db_save_compras_tarjeta(compras)) if compras else 0
+                repetidos = len(movs) + len(compras) - c
+                st.toast(f"✅ {c} movimientos procesados" + (f" ({repetidos} ya estaban cargados)" if repetidos else ""))
                 time.sleep(0.6)
                 st.rerun()
         else:
@@ -863,96 +1812,35 @@ elif menu == "➕ Nueva Operación":
         up = st.file_uploader("Excel/CSV Santander/Galicia (o similar)", type=["xlsx", "csv"])
         if up:
             try:
-                if up.name.endswith(".csv"):
-                    df_u = pd.read_csv(up)
-                else:
-                    raw = pd.read_excel(up)
-                    head = 0
-                    for i in range(len(raw)):
-                        rowvals = [str(x).upper() for x in raw.iloc[i].values]
-                        if any("FECHA" in v for v in rowvals):
-                            head = i + 1
-                            break
-                    df_u = pd.read_excel(up, skiprows=head)
-
-                df_u = df_u.dropna(how="all").reset_index(drop=True)
+                df_u = read_bank_file(up.getvalue(), up.name)
                 st.dataframe(df_u.head(5), use_container_width=True)
+                layout = detect_layout(list(df_u.columns))
+                cols_u = list(df_u.columns)
+
+                def _idx(key):
+                    return cols_u.index(layout[key]) if layout.get(key) in cols_u else 0
 
                 with st.form("imp"):
                     tarjetas = df_cta[df_cta["tipo"] == "CREDITO"]["nombre"].tolist() if not df_cta.empty else []
                     sel = st.selectbox("Tarjeta Destino", tarjetas)
 
                     c1, c2, c3 = st.columns(3)
-                    fc = c1.selectbox("Col. Fecha", df_u.columns)
-                    dc = c2.selectbox("Col. Detalle", df_u.columns)
-                    mc = c3.selectbox("Col. Pesos", df_u.columns)
+                    fc = c1.selectbox("Col. Fecha", cols_u, index=_idx("fecha"))
+                    dc = c2.selectbox("Col. Detalle", cols_u, index=_idx("detalle"))
+                    mc = c3.selectbox("Col. Pesos", cols_u, index=_idx("pesos"))
 
                     if st.form_submit_button("Importar"):
                         if not sel:
                             st.error("No hay tarjetas cargadas.")
                         else:
                             tid = df_cta[df_cta["nombre"] == sel]["id"].values[0]
-
-                            # map de categorías por nombre
-                            cat_by_name = {str(r["nombre"]): str(r["id"]) for _, r in df_cat.iterrows()} if not df_cat.empty else {}
-                            cat_default_name = "General" if "General" in cat_by_name else (df_cat.iloc[0]["nombre"] if not df_cat.empty else "General")
-                            cat_default_id = cat_by_name.get(cat_default_name)
-
-                            inserted = 0
-                            skipped = 0
-                            errors = 0
-
-                            for idx, r in df_u.iterrows():
-                                try:
-                                    desc = str(r[dc]).strip()
-                                    if not desc or desc.lower() == "nan":
-                                        continue
-
-                                    ms = str(r[mc]).replace("$", "").replace(" ", "")
-                                    val = parse_amount(ms)
-                                    fval = pd.to_datetime(r[fc], dayfirst=True, errors="coerce")
-                                    if pd.isna(fval):
-                                        continue
-                                    fval = fval.date()
-
-                                    # categoriza
-                                    cat_name = categorize_desc(desc, df_cat)
-                                    cat_id = cat_by_name.get(cat_name, cat_default_id)
-
-                                    # dedupe básico en compras_tarjeta
-                                    exists = (
-                                        supabase.table("compras_tarjeta")
-                                        .select("id")
-                                        .eq("fecha_compra", str(fval))
-                                        .eq("monto_total", float(val))
-                                        .eq("cuenta_id", str(tid))
-                                        .eq("descripcion", desc)
-                                        .limit(1)
-                                        .execute()
-                                    )
-                                    if exists.data:
-                                        skipped += 1
-                                        continue
-
-                                    # inserta como compra de 1 cuota
-                                    db_save_compra_tarjeta(
-                                        fecha_compra=fval,
-                                        monto_total=val,
-                                        cuotas_total=1,
-                                        cuenta_id=tid,
-                                        categoria_id=cat_id,
-                                        descripcion=desc,
-                                        source="excel",
-                                        raw_reference=f"{up.name}:row{idx}",
-                                        merchant=desc
-                                    )
-                                    inserted += 1
-
-                                except Exception as e:
-                                    errors += 1
-                                    log_import_error("excel", f"Row {idx}: {e}", {"row": int(idx), "detalle": str(r.to_dict())})
-
-                            st.success(f"Importado: {inserted} | Duplicados: {skipped} | Errores: {errors}")
+                            remember_layout(cols_u, {"fecha": fc, "detalle": dc, "pesos": mc})
+                            res = import_compras_tarjeta(df_u, fc, dc, mc, tid, df_cat, up.name)
+                            rate = res["rows"] / res["seconds"] if res["seconds"] > 0 else 0
+                            st.success(
+                                f"Importado: {res['inserted']} | Duplicados: {res['skipped']} | Errores: {res['errors']}"
+                                f" — {res['rows']} filas en {res['seconds']:.2f}s ({rate:.0f} filas/s)"
+                            )
                             time.sleep(0.6)
                             st.rerun()
 
@@ -983,15 +1871,21 @@ elif "Inversiones" in menu:
                 cat_id = df_cat[df_cat["nombre"] == "General"]["id"].values[0] if not df_cat[df_cat["nombre"] == "Inversiones"].empty else df_cat.iloc[0]["id"]
                 
                 # Guardamos como TRANSFERENCIA para que no sume al gasto de consumo, pero reste caja
-                db_save_mov(f_inv, m_inv, f"Inversión: {d_inv}", id_c, cat_id, "TRANSFERENCIA", source="manual")
+                try:
+                    db_save_mov(f_inv, m_inv, f"Inversión: {d_inv}", id_c, cat_id, "TRANSFERENCIA", source="manual", subtipo="INVERSION")
+                except Exception as e:
+                    if not missing_column(e, "subtipo"):
+                        raise
+                    # sin la migración de subtipo: queda sólo el marcador en la descripción (el listado lo sigue viendo)
+                    db_save_mov(f_inv, m_inv, f"Inversión: {d_inv}", id_c, cat_id, "TRANSFERENCIA", source="manual")
                 st.toast("✅ Inversión registrada")
                 time.sleep(0.5); st.rerun()
     
-    # 2. Ver Historial Inversiones (Filtrando por descripción o tipo)
-    # Nota: Como usamos TRANSFERENCIA, filtramos por descripción que empiece con "Inversión:"
-    df_inv = get_movimientos(date(2024,1,1), date(2025,12,31)) # Traer todo o ajustar rango
+    # 2. Ver Historial Inversiones (subtipo INVERSION, consultado en el servidor)
+    df_inv = get_inversiones()
     if not df_inv.empty:
-        df_inv = df_inv[df_inv["descripcion"].str.contains("Inversión:", case=False, na=False)]
+        cta_names = dict(zip(df_cta["id"].astype(str), df_cta["nombre"].astype(str))) if not df_cta.empty else {}
+        df_inv["cuenta"] = df_inv["cuenta_id"].astype(str).map(cta_names).fillna("Efectivo")
     
     if not df_inv.empty:
         st.markdown("#### Historial")
@@ -1045,62 +1939,136 @@ elif "Metas" in menu:
 elif "Historial" in menu:
     st.markdown("### 📝 Historial")
 
+    cta_names = dict(zip(df_cta["id"].astype(str), df_cta["nombre"].astype(str))) if not df_cta.empty else {}
+    cat_names = dict(zip(df_cat["id"].astype(str), (df_cat["icono"].fillna("") + " " + df_cat["nombre"]).str.strip())) if not df_cat.empty else {}
+
+    def hist_filtros(key: str, tipos: list | None) -> dict:
+        """Widgets de filtro -> dict para get_history_page (todo se filtra en el servidor)."""
+        with st.expander("🔎 Filtros", expanded=False):
+            c1, c2, c3 = st.columns(3)
+            periodo = c1.radio("Período", ["Mes seleccionado", "Todo el histórico"], horizontal=True, key=f"{key}_per")
+            cta = c2.selectbox("Cuenta", ["Todas"] + list(cta_names), format_func=lambda x: cta_names.get(x, x), key=f"{key}_cta")
+            cat = c3.selectbox("Categoría", ["Todas"] + list(cat_names), format_func=lambda x: cat_names.get(x, x), key=f"{key}_cat")
+            c4, c5, c6, c7 = st.columns([1, 1, 1, 2])
+            tipo = c4.selectbox("Tipo", ["Todos"] + tipos, key=f"{key}_tipo") if tipos else "Todos"
+            m_min = c5.number_input("Monto desde", min_value=0.0, value=0.0, step=1000.0, key=f"{key}_min")
+            m_max = c6.number_input("Monto hasta (0 = sin tope)", min_value=0.0, value=0.0, step=1000.0, key=f"{key}_max")
+            texto = c7.text_input("Descripción contiene", key=f"{key}_txt")
+        return {
+            "desde": f_ini if periodo == "Mes seleccionado" else None,
+            "hasta": f_fin if periodo == "Mes seleccionado" else None,
+            "cuenta_id": None if cta == "Todas" else cta,
+            "categoria_id": None if cat == "Todas" else cat,
+            "tipo": None if tipo == "Todos" else tipo,
+            "monto_min": m_min or None,
+            "monto_max": m_max or None,
+            "texto": texto.strip() or None,
+        }
+
+    def hist_pagina(tabla: str, filtros: dict, key: str) -> pd.DataFrame:
+        """Página actual; la pila de cursores vive en session_state y se reinicia si cambian los filtros."""
+        size = st.session_state.get(f"{key}_size", HIST_PAGE)
+        state = st.session_state.setdefault(f"{key}_pager", {"sig": None, "stack": [None]})
+        sig = (tuple(sorted(filtros.items())), size)
+        if state["sig"] != sig:
+            state["sig"], state["stack"] = sig, [None]
+        df, nxt = get_history_page(tabla, filtros, state["stack"][-1], size)
+
+        p1, p2, p3, p4 = st.columns([1, 1, 2, 1])
+        if p1.button("⬅️ Anterior", key=f"{key}_prev", disabled=len(state["stack"]) == 1):
+            state["stack"].pop()
+            st.rerun()
+        if p2.button("Siguiente ➡️", key=f"{key}_next", disabled=nxt is None):
+            state["stack"].append(nxt)
+            st.rerun()
+        p3.caption(f"Página {len(state['stack'])} · {len(df)} filas")
+        p4.selectbox("Filas", [25, 50, 100, 200], index=[25, 50, 100, 200].index(size), key=f"{key}_size", label_visibility="collapsed")
+
+        if not df.empty:
+            df["cuenta"] = df["cuenta_id"].astype(str).map(cta_names).fillna("Efectivo")
+            df["categoria"] = df["categoria_id"].astype(str).map(cat_names).fillna("General")
+        return df
+
+    def editor_key(key: str, df: pd.DataFrame) -> str:
+        """Key del data_editor atada a los ids de la página: las marcas 🗑️ no pasan a otras filas."""
+        return f"{key}_ed_{hash(tuple(df['id'].astype(str)))}"
+
     tab_mov, tab_comp = st.tabs(["Movimientos (cash/pagos)", "Compras Tarjeta (entidad)"])
 
     # -------- Movimientos
     with tab_mov:
-        check_col, _ = st.columns([1, 3])
-        ver_todo = check_col.checkbox("Ver todo histórico (movimientos)")
-        df_h = get_movimientos(date(2024, 1, 1), date(2027, 1, 1), back_months=0) if ver_todo else get_movimientos(f_ini, f_fin, back_months=0)
-        if not ver_todo and not df_h.empty:
-            df_h = df_h[(df_h["fecha"] >= f_ini) & (df_h["fecha"] <= f_fin)]
+        filtros = hist_filtros("hmov", ["GASTO", "INGRESO", "TRANSFERENCIA", "PAGO_TARJETA", "COMPRA_TARJETA"])
+        df_h = hist_pagina("movimientos", filtros, "hmov")
 
         if not df_h.empty:
-            st.data_editor(
-                df_h[["id", "fecha", "descripcion", "monto", "cuenta", "tipo"]],
-                column_config={"monto": st.column_config.NumberColumn("Monto", format="$ %.2f")},
-                use_container_width=True, hide_index=True
+            cols = ["fecha", "descripcion", "monto", "cuenta", "categoria", "tipo", "raw_reference"]
+            ed_key = editor_key("hmov", df_h)
+            ed_h = st.data_editor(
+                df_h[cols].assign(borrar=False)[["borrar"] + cols],
+                column_config={
+                    "borrar": st.column_config.CheckboxColumn("🗑️", default=False),
+                    "monto": st.column_config.NumberColumn("Monto", format="$ %.2f"),
+                },
+                disabled=cols, use_container_width=True, hide_index=True, key=ed_key
             )
-            with st.expander("🗑️ Borrado (movimientos)"):
-                ops = {f"{r['fecha']} | {r.get('descripcion','')} | {fmt_ars(r['monto'])}": r["id"] for _, r in df_h.iterrows()}
-                s = st.selectbox("Elegir:", ["..."] + list(ops.keys()))
-                if st.button("Eliminar Item") and s != "...":
-                    db_delete_mov(ops[s])
-                    st.toast("Eliminado")
-                    time.sleep(0.5)
-                    st.rerun()
+            sel = df_h.loc[ed_h["borrar"].to_numpy(dtype=bool), "id"].tolist()
+            if st.button(f"🗑️ Eliminar seleccionados ({len(sel)})", disabled=not sel, key="hmov_del"):
+                n = db_delete_movs(sel)
+                st.session_state.pop(ed_key, None)
+                st.toast(f"Eliminados {n} movimientos")
+                time.sleep(0.5)
+                st.rerun()
         else:
-            st.info("Sin datos en movimientos.")
+            st.info("Sin movimientos para estos filtros.")
 
     # -------- Compras tarjeta
     with tab_comp:
-        check_col2, _ = st.columns([1, 3])
-        ver_todo_c = check_col2.checkbox("Ver todo histórico (compras tarjeta)")
-        df_c = get_compras_tarjeta(date(2024, 1, 1), date(2027, 1, 1)) if ver_todo_c else get_compras_tarjeta(f_ini, f_fin)
+        filtros_c = hist_filtros("hcomp", None)
+        df_c = hist_pagina("compras_tarjeta", filtros_c, "hcomp")
 
         if not df_c.empty:
-            # map nombres
-            cta_map = dict(zip(df_cta["id"].astype(str), df_cta["nombre"].astype(str))) if not df_cta.empty else {}
-            cat_map = dict(zip(df_cat["id"].astype(str), (df_cat["icono"].fillna("") + " " + df_cat["nombre"]).str.strip())) if not df_cat.empty else {}
-            df_c["cuenta"] = df_c["cuenta_id"].astype(str).map(cta_map).fillna("Tarjeta")
-            df_c["categoria"] = df_c["categoria_id"].astype(str).map(cat_map).fillna("General")
-
-            st.dataframe(
-                df_c[["fecha_compra","descripcion","cuenta","categoria","monto_total","cuotas_total","source"]],
-                use_container_width=True,
-                hide_index=True
+            cols = ["fecha_compra","descripcion","cuenta","categoria","monto_total","cuotas_total","source","raw_reference"]
+            ed_key = editor_key("hcomp", df_c)
+            ed_c = st.data_editor(
+                df_c[cols].assign(borrar=False)[["borrar"] + cols],
+                column_config={
+                    "borrar": st.column_config.CheckboxColumn("🗑️", default=False),
+                    "monto_total": st.column_config.NumberColumn("Monto", format="$ %.2f"),
+                },
+                disabled=cols, use_container_width=True, hide_index=True, key=ed_key
             )
-
-            with st.expander("🗑️ Borrado (compras tarjeta)"):
-                ops = {f"{r['fecha_compra']} | {r['descripcion']} | {r['cuenta']} | {fmt_ars(r['monto_total'])}": r["id"] for _, r in df_c.iterrows()}
-                s = st.selectbox("Elegir compra:", ["..."] + list(ops.keys()), key="delcomp")
-                if st.button("Eliminar Compra (borra cuotas)") and s != "...":
-                    db_delete_compra_tarjeta(ops[s])
-                    st.toast("Compra eliminada")
-                    time.sleep(0.5)
-                    st.rerun()
+            sel = df_c.loc[ed_c["borrar"].to_numpy(dtype=bool), "id"].tolist()
+            if st.button(f"🗑️ Eliminar seleccionadas ({len(sel)}, borra cuotas)", disabled=not sel, key="hcomp_del"):
+                n = db_delete_compras_tarjeta(sel)
+                st.session_state.pop(ed_key, None)
+                st.toast(f"Eliminadas {n} compras")
+                time.sleep(0.5)
+                st.rerun()
         else:
-            st.info("Sin compras tarjeta en el rango.")
+            st.info("Sin compras tarjeta para estos filtros.")
+
+    # -------- Deshacer una importación completa
+    with st.expander("🧹 Borrar una importación (por archivo / raw_reference)"):
+        vistos = pd.concat([df.get("raw_reference", pd.Series(dtype=object)) for df in (df_h, df_c)], ignore_index=True).dropna().astype(str)
+        archivos = sorted({r.rsplit(":row", 1)[0] for r in vistos if ":row" in r})
+        if archivos:
+            st.caption("Archivos en las páginas visibles: " + ", ".join(archivos))
+        ref = st.text_input("Archivo (o prefijo de raw_reference)", key="hdel_ref").strip()
+        prefix = (ref if ":" in ref else f"{ref}:") if ref else ""
+        # el expander corre en cada rerun aunque esté cerrado: sólo se consulta al pedirlo
+        if st.button("🔎 Buscar", disabled=not ref, key="hdel_buscar"):
+            st.session_state["hdel_conteo"] = (prefix, count_by_reference("movimientos", prefix), count_by_reference("compras_tarjeta", prefix))
+        conteo = st.session_state.get("hdel_conteo")
+        if conteo and conteo[0] == prefix:
+            _, n_mov, n_comp = conteo
+            st.write(f"Coinciden **{n_mov}** movimientos y **{n_comp}** compras tarjeta (con sus cuotas) para `{prefix}*`.")
+            ok = st.checkbox("Confirmo el borrado", key="hdel_ok")
+            if st.button("🧹 Borrar importación", disabled=not ok or not (n_mov or n_comp), type="primary", key="hdel_btn"):
+                r = db_delete_by_reference(prefix)
+                st.session_state.pop("hdel_conteo", None)
+                st.toast(f"Eliminados {r['movimientos']} movimientos y {r['compras_tarjeta']} compras")
+                time.sleep(0.5)
+                st.rerun()
 
 # =========================================================
 # 17) TARJETAS (mejorado)
@@ -1126,41 +2094,30 @@ elif "Tarjetas" in menu:
 
             # ----------------- ESTADO
             with tab_estado:
-                for _, card in df_cards.iterrows():
+                est, tj_tag, pg_tag = card_statements(df_cards, df_tj_ext, df_mov_ext, hoy)
+                stmt_by_card = dict(tuple(tj_tag[tj_tag["periodo"] == "stmt"].groupby("_card")))
+                pagos_by_card = dict(tuple(pg_tag.groupby("_card")))
+
+                for (_, card), (_, e) in zip(df_cards.iterrows(), est.iterrows()):
                     card_id = str(card["id"])
                     card_name = str(card["nombre"])
-                    dia_cierre = int(card.get("dia_cierre") or 25)
-                    dia_vto = int(card.get("dia_vencimiento") or 5)
                     limite_total = card.get("limite_total", None)
                     pago_min_pct = float(card.get("pago_minimo_pct") or 0.10)
                     pago_min_fijo = card.get("pago_minimo_fijo", None)
 
-                    cierre = last_cierre_date(hoy, dia_cierre)
-                    prev = prev_cierre_date(cierre, dia_cierre)
-                    vto = due_date_from_cierre(cierre, dia_vto)
-                    next_cierre = next_cierre_date(hoy, dia_cierre)
+                    cierre = e["cierre"]
+                    vto = e["vto"]
+                    next_cierre = e["next_cierre"]
 
-                    stmt_start = prev + timedelta(days=1)
+                    stmt_start = e["stmt_start"]
                     stmt_end = cierre
-                    open_start = cierre + timedelta(days=1)
+                    open_start = e["open_start"]
                     open_end = hoy
 
-                    stmt_total = df_tj_ext[(df_tj_ext["cuenta_id"] == card_id) &
-                                            (df_tj_ext["fecha"] >= stmt_start) &
-                                            (df_tj_ext["fecha"] <= stmt_end)]["monto"].sum()
-
-                    open_total = df_tj_ext[(df_tj_ext["cuenta_id"] == card_id) &
-                                            (df_tj_ext["fecha"] >= open_start) &
-                                            (df_tj_ext["fecha"] <= open_end)]["monto"].sum()
-
-                    pagos = 0.0
-                    if not df_mov_ext.empty:
-                        pagos = df_mov_ext[(df_mov_ext["tipo"] == "PAGO_TARJETA") &
-                                            (df_mov_ext["cuenta_destino_id"].astype(str) == card_id) &
-                                            (df_mov_ext["fecha"] >= cierre) &
-                                            (df_mov_ext["fecha"] <= vto)]["monto"].sum()
-
-                    saldo_pend = max(stmt_total - pagos, 0.0)
+                    stmt_total = e["stmt_total"]
+                    open_total = e["open_total"]
+                    pagos = e["pagos"]
+                    saldo_pend = e["saldo_pend"]
 
                     # mínimo simulado
                     if pago_min_fijo is not None and str(pago_min_fijo) != "nan":
@@ -1210,9 +2167,7 @@ elif "Tarjetas" in menu:
                             st.info("\n\n".join(alerts))
 
                         # Gráfico por categoría (del resumen a pagar)
-                        df_stmt = df_tj_ext[(df_tj_ext["cuenta_id"] == card_id) &
-                                            (df_tj_ext["fecha"] >= stmt_start) &
-                                            (df_tj_ext["fecha"] <= stmt_end)].copy()
+                        df_stmt = stmt_by_card.get(card_id, pd.DataFrame(columns=["fecha","descripcion","monto","categoria"]))
 
                         if not df_stmt.empty:
                             agg = df_stmt.groupby("categoria", as_index=False)["monto"].sum().sort_values("monto", ascending=False)
@@ -1251,11 +2206,8 @@ elif "Tarjetas" in menu:
 
                             st.write("**Pagos aplicados (cierre → vto)**")
                             df_p = pd.DataFrame()
-                            if not df_mov_ext.empty:
-                                df_p = df_mov_ext[(df_mov_ext["tipo"] == "PAGO_TARJETA") &
-                                                    (df_mov_ext["cuenta_destino_id"].astype(str) == card_id) &
-                                                    (df_mov_ext["fecha"] >= cierre) &
-                                                    (df_mov_ext["fecha"] <= vto)][["fecha","descripcion","monto","cuenta"]].copy()
+                            if card_id in pagos_by_card:
+                                df_p = pagos_by_card[card_id][["fecha","descripcion","monto","cuenta"]]
                             if not df_p.empty:
                                 st.dataframe(df_p.sort_values("fecha"), use_container_width=True, hide_index=True)
                             else:
@@ -1286,7 +2238,7 @@ elif "Tarjetas" in menu:
                                 "pago_minimo_fijo": float(minfix) if minfix > 0 else None,
                             }
                             supabase.table("cuentas").update(payload).eq("id", r["id"]).execute()
-                            invalidate_caches()
+                            invalidate("cuentas")
                             st.toast("Actualizado")
                             time.sleep(0.3)
                             st.rerun()
@@ -1361,7 +2313,7 @@ elif "Ajustes" in menu:
         c_btn.write("") 
         if c_btn.button("Actualizar Sueldo"):
             supabase.table("configuracion").upsert({"clave": "sueldo_mensual", "valor": str(int(ns))}).execute()
-            invalidate_caches()
+            invalidate("configuracion")
             st.toast("✅ Sueldo base actualizado")
             time.sleep(0.5)
             st.rerun()
@@ -1380,7 +2332,7 @@ elif "Ajustes" in menu:
                     new_budget = c2.number_input("Tope Mensual", value=current_budget, key=f"pres_{cat['id']}")
                     if c3.button("Guardar", key=f"btn_pres_{cat['id']}"):
                         supabase.table("categorias").update({"presupuesto_mensual": new_budget}).eq("id", cat['id']).execute()
-                        invalidate_caches()
+                        invalidate("categorias")
                         st.toast(f"Presupuesto {cat['nombre']} actualizado")
     
     # --- D. FIJOS ---
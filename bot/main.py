@@ -3,12 +3,19 @@ import re
 import asyncio
 import logging
 import json
+import hashlib
+import hmac
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 import io
+from collections import deque
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from supabase import create_client
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.constants import ParseMode, ChatAction
@@ -24,6 +31,16 @@ from telegram.ext import (
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 
+# PREPROCESAMIENTO (opcionales: sin ellos se manda el archivo tal cual)
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = None
+
 # ==========================================
 # 1. CONFIGURACIÓN Y CONSTANTES
 # ==========================================
@@ -32,9 +49,42 @@ SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or os.environ.get("SU
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_SECRET") or os.environ.get("TELEGRAM_TOKEN")
 ALLOWED_USER_ID = os.environ.get("ALLOWED_USER_ID")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+MASTER_CACHE_TTL = int(os.environ.get("MASTER_CACHE_TTL", "300"))  # segundos
+MASTER_RETRY_SECONDS = int(os.environ.get("MASTER_RETRY_SECONDS", "10"))  # reintento si no hay maestros cargados
+DB_WORKERS = int(os.environ.get("DB_WORKERS", "8"))            # hilos para llamadas a Supabase
+DB_TIMEOUT = float(os.environ.get("DB_TIMEOUT", "10"))         # segundos por llamada
+BOT_CONCURRENCY = int(os.environ.get("BOT_CONCURRENCY", "16"))  # updates procesados en paralelo
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "2"))      # análisis de comprobantes simultáneos
+ANALYSIS_QUEUE_MAX = int(os.environ.get("ANALYSIS_QUEUE_MAX", "50"))  # archivos en espera antes de rechazar
+ANALYSIS_CACHE_PATH = os.environ.get("ANALYSIS_CACHE_PATH", ".cache/analysis_cache.sqlite")  # vacío = sin cache
+RECEIPT_MAX_PIXELS = int(os.environ.get("RECEIPT_MAX_PIXELS", "2000000"))  # área máxima que se manda a la IA (~1600x1200)
+RECEIPT_JPEG_QUALITY = int(os.environ.get("RECEIPT_JPEG_QUALITY", "80"))
+PDF_MAX_PAGES = int(os.environ.get("PDF_MAX_PAGES", "2"))  # páginas de un PDF que se mandan a la IA
+# Modo webhook (opcional): si hay WEBHOOK_URL, Telegram empuja los updates a POST {WEBHOOK_URL}{WEBHOOK_PATH}
+WEBHOOK_URL = (os.environ.get("WEBHOOK_URL") or "").rstrip("/")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
 
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# El cliente de supabase es síncrono: las llamadas corren en un pool acotado
+# para no bloquear el event loop de los handlers.
+DB_POOL = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+async def db_call(fn, *args, timeout=None):
+    """Ejecuta fn(*args) en DB_POOL; corta la espera a los DB_TIMEOUT segundos."""
+    loop = asyncio.get_running_loop()
+    timeout = timeout or DB_TIMEOUT
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(DB_POOL, fn, *args), timeout)
+    except asyncio.TimeoutError:
+        # el hilo sigue hasta que la llamada HTTP termine; sólo dejamos de esperarlo
+        raise TimeoutError(f"DB timeout ({timeout:.0f}s) en {getattr(fn, '__qualname__', fn)}")
+
+async def db_exec(query, timeout=None):
+    """Atajo: await db_exec(supabase.table(...).select(...)) -> respuesta de .execute()"""
+    return await db_call(query.execute, timeout=timeout)
+
 # Configuración de IA (Gemini)
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
@@ -74,10 +124,78 @@ logger = logging.getLogger(__name__)
 def fmt_money(val):
     return f"${val:,.0f}".replace(",", ".")
 
+class MasterCache:
+    """
+    Cache en memoria de las tablas maestras (cuentas, categorias, configuracion).
+    Se carga en el arranque y se refresca en segundo plano cada MASTER_CACHE_TTL;
+    los handlers leen el último snapshot sin ir a la DB.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.snapshot = None
+        self.loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        self._retry = None  # refresh en segundo plano pedido por un lector sin snapshot
+        self._retry_at = 0.0
+
+    def _fetch(self):
+        cuentas = supabase.table("cuentas").select("*").execute().data or []
+        categorias = supabase.table("categorias").select("*").execute().data or []
+        config = supabase.table("configuracion").select("clave, valor").execute().data or []
+        return {
+            "cuentas": cuentas,
+            "categorias": categorias,
+            "configuracion": {r['clave']: r['valor'] for r in config},
+        }
+
+    def _get(self):
+        # Sin snapshot (p.ej. falló el arranque): nada de requests bloqueantes en el loop;
+        # se devuelve vacío y se agenda un refresh, como mucho uno cada MASTER_RETRY_SECONDS
+        if self.snapshot is None:
+            self._schedule_retry()
+            return {"cuentas": [], "categorias": [], "configuracion": {}}
+        return self.snapshot
+
+    def _schedule_retry(self):
+        if (self._retry and not self._retry.done()) or time.monotonic() - self._retry_at < MASTER_RETRY_SECONDS:
+            return
+        try:
+            self._retry = asyncio.get_running_loop().create_task(self.refresh())
+            self._retry_at = time.monotonic()
+        except RuntimeError:
+            pass  # fuera del loop (hilo del pool): el refresher periódico lo reintenta
+
+    def cuentas(self): return self._get()["cuentas"]
+    def categorias(self): return self._get()["categorias"]
+    def config(self, clave, default=None): return self._get()["configuracion"].get(clave, default)
+
+    def is_stale(self):
+        return self.snapshot is None or time.monotonic() - self.loaded_at >= self.ttl
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+    async def refresh(self, force=False):
+        async with self._lock:
+            # Si otro refresh terminó mientras esperábamos el lock, no repetimos
+            if not force and not self.is_stale(): return
+            try:
+                snap = await db_call(self._fetch, timeout=DB_TIMEOUT * 3)
+                self.snapshot = snap  # reemplazo atómico: los lectores ven el viejo o el nuevo
+                self.loaded_at = time.monotonic()
+            except Exception as e:
+                logger.error(f"Master cache refresh error: {e}")
+
+    async def run_refresher(self):
+        while True:
+            await asyncio.sleep(max(1, min(self.ttl, 30)))
+            if self.is_stale(): await self.refresh()
+
+MASTER = MasterCache(MASTER_CACHE_TTL)
+
 def get_account_by_name(name):
     try:
-        res = supabase.table("cuentas").select("*").execute()
-        cuentas = res.data or []
+        cuentas = MASTER.cuentas()
         for acc in cuentas:
             if name and name.lower() in acc['nombre'].lower(): return acc
         for acc in cuentas:
@@ -85,33 +203,76 @@ def get_account_by_name(name):
         return cuentas[0] if cuentas else None
     except: return None
 
+# Palabras clave por categoría (se compilan una sola vez en CATEGORY_MATCHER)
+KEYWORDS_MAP = {
+    "Comida": ["mcdonald", "burger", "pizza", "restaurante", "cena", "almuerzo", "delivery", "pedidosya", "rappi", "cafe", "starbucks", "bar", "comidas", "bebidas", "market", "kiosco"],
+    "Supermercado": ["coto", "dia", "jumbo", "carrefour", "super", "chino", "vea", "chango", "disco", "carniceria", "verduleria", "fruteria"],
+    "Transporte": ["uber", "taxi", "nafta", "cabify", "sube", "tren", "bondi", "colectivo", "peaje", "estacionamiento", "shell", "ypf", "axion"],
+    "Servicios": ["luz", "gas", "internet", "celular", "claro", "personal", "movistar", "flow", "cable", "edenor", "edesur", "metrogas", "abl", "agua"],
+    "Salud": ["farmacia", "medico", "doctor", "remedios", "obra social", "dentista", "swiss", "osde"],
+    "Salidas": ["cine", "boliche", "teatro", "entrada", "recital", "juego"],
+    "Ropa": ["zapatillas", "remera", "pantalon", "nike", "adidas", "zara", "shopping", "indumentaria"],
+    "Transferencias": ["transferencia", "envio", "pago a", "destinatario"]
+}
+
+class KeywordMatcher:
+    """
+    Autómata Aho-Corasick: encuentra todas las palabras clave en una sola pasada
+    sobre el texto, sin importar cuántas haya cargadas.
+    """
+    def __init__(self, keywords_map):
+        self.goto = [{}]   # transiciones por nodo
+        self.fail = [0]    # enlace de falla por nodo
+        self.out = [[]]    # (largo, orden, categoría) que terminan en el nodo
+        order = 0
+        for cat_name, terms in keywords_map.items():
+            for term in terms:
+                node = 0
+                for ch in term.lower():
+                    nxt = self.goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self.goto)
+                        self.goto[node][ch] = nxt
+                        self.goto.append({}); self.fail.append(0); self.out.append([])
+                    node = nxt
+                self.out[node].append((len(term), order, cat_name))
+                order += 1
+
+        # BFS para los enlaces de falla; cada nodo hereda las salidas de su sufijo
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]: f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+
+    def find_all(self, text):
+        """Devuelve (inicio, largo, orden, categoría) de cada aparición."""
+        hits = []
+        node = 0
+        for i, ch in enumerate(text.lower()):
+            while node and ch not in self.goto[node]: node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for length, order, cat_name in self.out[node]:
+                hits.append((i - length + 1, length, order, cat_name))
+        return hits
+
+    def best(self, text):
+        """La coincidencia más específica: la más larga; a igual largo, la primera del texto."""
+        hits = self.find_all(text)
+        if not hits: return None
+        return min(hits, key=lambda h: (-h[1], h[0], h[2]))[3]
+
+CATEGORY_MATCHER = KeywordMatcher(KEYWORDS_MAP)
+
 def get_smart_category(description):
-    text = description.lower()
-    keywords_map = {
-        "Comida": ["mcdonald", "burger", "pizza", "restaurante", "cena", "almuerzo", "delivery", "pedidosya", "rappi", "cafe", "starbucks", "bar", "comidas", "bebidas", "market", "kiosco"],
-        "Supermercado": ["coto", "dia", "jumbo", "carrefour", "super", "chino", "vea", "chango", "disco", "carniceria", "verduleria", "fruteria"],
-        "Transporte": ["uber", "taxi", "nafta", "cabify", "sube", "tren", "bondi", "colectivo", "peaje", "estacionamiento", "shell", "ypf", "axion"],
-        "Servicios": ["luz", "gas", "internet", "celular", "claro", "personal", "movistar", "flow", "cable", "edenor", "edesur", "metrogas", "abl", "agua"],
-        "Salud": ["farmacia", "medico", "doctor", "remedios", "obra social", "dentista", "swiss", "osde"],
-        "Salidas": ["cine", "boliche", "teatro", "entrada", "recital", "juego"],
-        "Ropa": ["zapatillas", "remera", "pantalon", "nike", "adidas", "zara", "shopping", "indumentaria"],
-        "Transferencias": ["transferencia", "envio", "pago a", "destinatario"]
-    }
+    target_cat_name = CATEGORY_MATCHER.best(description or "") or "General"
 
     try:
-        res = supabase.table("categorias").select("*").execute()
-        all_cats = res.data or []
-        target_cat_name = "General"
+        all_cats = MASTER.categorias()
 
-        found = False
-        for cat_name, terms in keywords_map.items():
-            for term in terms:
-                if term in text:
-                    target_cat_name = cat_name
-                    found = True
-                    break
-            if found: break
-        
         for cat in all_cats:
             if target_cat_name.lower() in cat['nombre'].lower(): return cat
         for cat in all_cats:
@@ -121,32 +282,54 @@ def get_smart_category(description):
 
 def get_base_salary():
     try:
-        res = supabase.table("configuracion").select("valor").eq("clave", "sueldo_mensual").execute()
-        if res.data: return float(res.data[0]['valor'])
-        return 0.0
+        valor = MASTER.config("sueldo_mensual")
+        return float(valor) if valor is not None else 0.0
     except: return 0.0
 
-def get_monthly_balance():
+# False si la tabla resumen_mensual no existe (migración sin aplicar): se calcula desde las filas
+RESUMEN_MENSUAL = {"ok": True}
+
+async def get_monthly_balance():
+    """(ingresos, gastos cash, gastos tarjeta) del mes; mismo criterio que el Dashboard de la app."""
     try:
         today = date.today()
         first_day = date(today.year, today.month, 1)
         last_day = first_day + relativedelta(months=1) - timedelta(days=1)
         sueldo_base = get_base_salary()
-        
-        res = supabase.table("movimientos").select("tipo, monto").gte("fecha", str(first_day)).lte("fecha", str(last_day)).execute()
+
+        if RESUMEN_MENSUAL["ok"]:
+            try:
+                # Una fila mantenida por triggers: O(1) sin importar cuántos movimientos haya
+                res = await db_exec(supabase.table("resumen_mensual").select("ingresos, gastos_cash, gastos_tarjeta").eq("mes", str(first_day)))
+                r = res.data[0] if res.data else {}
+                ing = float(r.get('ingresos') or 0)
+                return (ing if ing > 0 else sueldo_base), float(r.get('gastos_cash') or 0), float(r.get('gastos_tarjeta') or 0)
+            except Exception as e:
+                # sólo la tabla inexistente (PGRST205 / 42P01) apaga el resumen; timeouts y errores de red
+                # caen a las filas en esta consulta y se reintenta en la próxima
+                if "PGRST205" in str(e) or "42P01" in str(e):
+                    logger.error(f"resumen_mensual no existe, se calcula desde movimientos: {e}")
+                    RESUMEN_MENSUAL["ok"] = False
+                else:
+                    logger.error(f"resumen_mensual falló, se calcula desde movimientos en esta consulta: {e}")
+
+        res, cuotas = await asyncio.gather(
+            db_exec(supabase.table("movimientos").select("tipo, monto").gte("fecha", str(first_day)).lte("fecha", str(last_day))),
+            db_exec(supabase.table("cuotas_tarjeta").select("monto_cuota").gte("fecha_cuota", str(first_day)).lte("fecha_cuota", str(last_day))),
+        )
         data = res.data or []
         
         ing = sum(d['monto'] for d in data if d['tipo'] == 'INGRESO')
-        gas = sum(d['monto'] for d in data if d['tipo'] in ['GASTO', 'COMPRA_TARJETA'])
-        return (ing if ing > 0 else sueldo_base), gas
-    except: return 0, 0
+        cash = sum(d['monto'] for d in data if d['tipo'] == 'GASTO')
+        tj = sum(d['monto'] for d in data if d['tipo'] == 'COMPRA_TARJETA') + sum(c['monto_cuota'] or 0 for c in (cuotas.data or []))
+        return (ing if ing > 0 else sueldo_base), cash, tj
+    except: return 0, 0, 0
 
-# --- FUNCIÓN IA PRINCIPAL ---
-async def analyze_media(file_bytes, mime_type):
-    if not model: return None
-    try:
-        # Prompt optimizado para documentos financieros
-        prompt = """
+# Pool propio para Gemini: no compite con DB_POOL ni con el pool por defecto
+AI_POOL = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="ia")
+
+# Prompt optimizado para documentos financieros
+ANALYSIS_PROMPT = """
         Actúa como un sistema contable automatizado.
         Analiza este archivo (Imagen o PDF).
         
@@ -162,11 +345,148 @@ async def analyze_media(file_bytes, mime_type):
         2. Si es una transferencia, usa "Transferencia a [Destinatario]" como descripción.
         3. Ignora códigos de barras o números de serie.
         """
-        
-        part = {"mime_type": mime_type, "data": file_bytes}
-        
+# Cambiar el prompt invalida solo los resultados cacheados con el prompt anterior
+PROMPT_VERSION = hashlib.sha256(ANALYSIS_PROMPT.encode()).hexdigest()[:12]
+
+class AnalysisCache:
+    """
+    Resultados de la IA persistidos en SQLite, por hash(bytes + mime + versión de prompt).
+    También guarda qué movimiento generó cada comprobante para detectar reenvíos.
+    """
+    def __init__(self, path):
+        self.enabled = bool(path)
+        self._lock = threading.Lock()
+        if not self.enabled: return
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS analisis (
+                    hash TEXT PRIMARY KEY,
+                    mime TEXT,
+                    prompt_version TEXT,
+                    resultado TEXT NOT NULL,
+                    movimiento_id TEXT,
+                    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )""")
+            self.conn.commit()
+        except Exception as e:
+            logger.error(f"Analysis cache disabled: {e}")
+            self.enabled = False
+
+    @staticmethod
+    def key(file_bytes, mime_type):
+        h = hashlib.sha256(bytes(file_bytes))
+        h.update(f"|{mime_type}|{PROMPT_VERSION}".encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        if not self.enabled: return None
+        with self._lock:
+            row = self.conn.execute("SELECT resultado FROM analisis WHERE hash = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, mime_type, data):
+        if not self.enabled: return
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO analisis (hash, mime, prompt_version, resultado) VALUES (?, ?, ?, ?)",
+                (key, mime_type, PROMPT_VERSION, json.dumps(data)))
+            self.conn.commit()
+
+    def inserted_id(self, key):
+        if not self.enabled: return None
+        with self._lock:
+            row = self.conn.execute("SELECT movimiento_id FROM analisis WHERE hash = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def mark_inserted(self, key, movimiento_id):
+        if not self.enabled: return
+        with self._lock:
+            self.conn.execute("UPDATE analisis SET movimiento_id = ? WHERE hash = ?", (str(movimiento_id), key))
+            self.conn.commit()
+
+ANALYSIS_CACHE = AnalysisCache(ANALYSIS_CACHE_PATH)
+
+# --- PREPROCESAMIENTO DE ARCHIVOS ---
+PDF_KEYWORDS = ("TOTAL", "IMPORTE", "A PAGAR", "MONTO")
+
+def prepare_image(file_bytes):
+    """Endereza según EXIF, pasa a escala de grises, reduce a RECEIPT_MAX_PIXELS y re-encodea como JPEG."""
+    img = Image.open(io.BytesIO(file_bytes))
+    img = ImageOps.exif_transpose(img)
+    img = img.convert("L")
+    # Se limita el área (no el lado mayor) para que los tickets largos y angostos sigan legibles
+    scale = (RECEIPT_MAX_PIXELS / (img.width * img.height)) ** 0.5
+    if scale < 1:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=RECEIPT_JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+def prepare_pdf(file_bytes):
+    """Deja sólo las páginas que mencionan el total (o las primeras) hasta PDF_MAX_PAGES."""
+    reader = PdfReader(io.BytesIO(file_bytes))
+    if len(reader.pages) <= PDF_MAX_PAGES: return file_bytes
+    relevant = []
+    for i, page in enumerate(reader.pages):
+        try: text = (page.extract_text() or "").upper()
+        except Exception: text = ""
+        if any(k in text for k in PDF_KEYWORDS): relevant.append(i)
+    pages = (relevant or list(range(len(reader.pages))))[:PDF_MAX_PAGES]
+    writer = PdfWriter()
+    for i in pages: writer.add_page(reader.pages[i])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+def prepare_media(file_bytes, mime_type):
+    """Achica el archivo antes de mandarlo a la IA; si algo falla o no conviene, devuelve el original."""
+    file_bytes = bytes(file_bytes)
+    try:
+        if mime_type.startswith("image/") and Image:
+            small = prepare_image(file_bytes)
+            if len(small) < len(file_bytes): return small, "image/jpeg"
+        elif mime_type == "application/pdf" and PdfReader:
+            return prepare_pdf(file_bytes), mime_type
+    except Exception as e:
+        logger.error(f"Preprocess error ({mime_type}): {e}")
+    return file_bytes, mime_type
+
+# False si la RPC crear_compras_tarjeta no existe (migración sin aplicar)
+RPC_COMPRAS = {"ok": True}
+
+async def save_compra_tarjeta(compra):
+    """Compra con tarjeta + cuotas en un request atómico (RPC); en dos pasos si falta la función."""
+    if RPC_COMPRAS["ok"]:
+        try:
+            res = await db_exec(supabase.rpc("crear_compras_tarjeta", {"p_compras": [compra]}))
+            return res.data
+        except Exception as e:
+            if "PGRST202" not in str(e) and "Could not find the function" not in str(e): raise
+            logger.error(f"crear_compras_tarjeta no disponible, alta en dos pasos: {e}")
+            RPC_COMPRAS["ok"] = False
+    c = await db_exec(supabase.table("compras_tarjeta").insert(compra))
+    if c.data:
+        await db_exec(supabase.table("cuotas_tarjeta").insert({
+            "compra_id": c.data[0]['id'], "nro_cuota": 1, "fecha_cuota": compra['fecha_compra'], "monto_cuota": compra['monto_total'], "estado": "pendiente"
+        }))
+    return c.data
+
+# --- FUNCIÓN IA PRINCIPAL ---
+async def analyze_media(file_bytes, mime_type, key=None):
+    if not model: return None
+    key = key or ANALYSIS_CACHE.key(file_bytes, mime_type)
+    cached = ANALYSIS_CACHE.get(key)
+    if cached is not None: return cached
+    try:
         # Llamada a Gemini (ejecutando en thread aparte para no bloquear)
-        response = await asyncio.to_thread(model.generate_content, [prompt, part])
+        loop = asyncio.get_running_loop()
+        payload, payload_mime = await loop.run_in_executor(AI_POOL, prepare_media, file_bytes, mime_type)
+        part = {"mime_type": payload_mime, "data": payload}
+        
+        response = await loop.run_in_executor(AI_POOL, model.generate_content, [ANALYSIS_PROMPT, part])
         
         # Verificamos si la IA bloqueó la respuesta por seguridad (común en PDFs legales)
         if response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -174,20 +494,112 @@ async def analyze_media(file_bytes, mime_type):
             return None
             
         text_resp = response.text
-        return json.loads(text_resp)
+        data = json.loads(text_resp)
+        ANALYSIS_CACHE.put(key, mime_type, data)
+        return data
     except Exception as e:
         logger.error(f"Error IA Analysis: {e}")
         return None
 
+class AnalysisQueue:
+    """
+    Cola acotada de análisis de comprobantes.
+    - `workers` tareas procesan trabajos en paralelo; más allá de `max_pending` en espera se rechaza.
+    - Orden por usuario: cada usuario tiene su propia fila y nunca tiene dos trabajos en curso;
+      los usuarios con trabajo pendiente se atienden por turnos (round-robin).
+    - Guarda espera y latencia total de los últimos trabajos para medir throughput y p95.
+    """
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ready = None     # asyncio.Queue de user_ids con trabajo listo
+        self.jobs = {}        # user_id -> deque[(encolado, job)]; presente mientras el usuario está activo
+        self.pending = 0      # trabajos en espera (no iniciados)
+        self.busy = 0         # trabajos en curso
+        self.done = 0
+        self.tasks = []
+        self.waits = deque(maxlen=500)
+        self.latencies = deque(maxlen=500)
+        self.first_done_at = None
+        self.last_done_at = None
+
+    def start(self):
+        if self.ready is not None: return
+        self.ready = asyncio.Queue()
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self.tasks: t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.ready = None
+
+    def submit(self, user_id, job):
+        """Encola `job` (corutina sin argumentos). Devuelve la posición en la cola (0 = arranca ya) o None si está llena."""
+        self.start()
+        if self.pending >= self.max_pending: return None
+        idle = self.workers - self.busy
+        position = 0 if self.pending < idle else self.pending - idle + 1
+        q = self.jobs.get(user_id)
+        if q is not None:
+            # el usuario ya tiene archivos en curso/espera: este va detrás de todos ellos
+            position = max(position, len(q) + 1)
+        else:
+            q = self.jobs[user_id] = deque()
+            self.ready.put_nowait(user_id)
+        q.append((time.monotonic(), job))
+        self.pending += 1
+        return position
+
+    async def _worker(self):
+        while True:
+            user_id = await self.ready.get()
+            enqueued, job = self.jobs[user_id].popleft()
+            self.pending -= 1
+            self.busy += 1
+            started = time.monotonic()
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"Analysis job error: {e}")
+            finally:
+                self.busy -= 1
+                now = time.monotonic()
+                self.done += 1
+                self.waits.append(started - enqueued)
+                self.latencies.append(now - enqueued)
+                self.first_done_at = self.first_done_at or now
+                self.last_done_at = now
+                # El siguiente archivo del mismo usuario vuelve a la fila detrás de los demás
+                if self.jobs[user_id]: self.ready.put_nowait(user_id)
+                else: del self.jobs[user_id]
+
+    def stats(self):
+        def pct(values, p):
+            if not values: return None
+            s = sorted(values)
+            return round(s[min(len(s) - 1, int(p * len(s)))] * 1000)
+        lat = list(self.latencies)
+        span = (self.last_done_at or 0) - (self.first_done_at or 0)
+        return {
+            "workers": self.workers, "pending": self.pending, "busy": self.busy, "done": self.done,
+            "wait_p50_ms": pct(list(self.waits), 0.5),
+            "latency_p50_ms": pct(lat, 0.5), "latency_p95_ms": pct(lat, 0.95),
+            "throughput_per_min": round(60 * (len(lat) - 1) / span, 1) if span > 0 else None,
+        }
+
+ANALYSIS = AnalysisQueue(ANALYSIS_WORKERS, ANALYSIS_QUEUE_MAX)
+
 # ==========================================
 # 3. HANDLERS TELEGRAM
 # ==========================================
 
 async def reply_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ing, gas = get_monthly_balance()
+    ing, cash, tj = await get_monthly_balance()
+    gas = cash + tj
     mes_nombre = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"][date.today().month - 1]
     await update.message.reply_text(
-        f"📅 *Balance {mes_nombre}*\n\n📥 Ingresos: `{fmt_money(ing)}`\n🛒 Consumo:  `{fmt_money(gas)}`\n-------------------\n💵 *Neto: {fmt_money(ing - gas)}*",
+        f"📅 *Balance {mes_nombre}*\n\n📥 Ingresos: `{fmt_money(ing)}`\n🛒 Consumo:  `{fmt_money(gas)}`\n   💵 Cash: `{fmt_money(cash)}`\n   💳 Tarjeta: `{fmt_money(tj)}`\n-------------------\n💵 *Neto: {fmt_money(ing - gas)}*",
         parse_mode=ParseMode.MARKDOWN
     )
 
@@ -201,14 +613,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
-        "💡 *Ayuda:*\n📸 Manda **Fotos** o **PDFs** de comprobantes.\n✍️ Escribe: `1500 Super`\n↩️ `/deshacer` para borrar último.",
+        "💡 *Ayuda:*\n📸 Manda **Fotos** o **PDFs** de comprobantes.\n✍️ Escribe: `1500 Super`\n↩️ `/deshacer` para borrar último.\n🔄 `/recargar` si cambiaste cuentas/categorías.",
         parse_mode=ParseMode.MARKDOWN
     )
 
+async def reload_masters(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Invalida el cache de maestros (p.ej. después de crear una cuenta desde la app)
+    if ALLOWED_USER_ID and str(update.effective_user.id) != str(ALLOWED_USER_ID): return
+    MASTER.invalidate()
+    await MASTER.refresh()
+    await update.message.reply_text(f"🔄 Datos recargados: {len(MASTER.cuentas())} cuentas, {len(MASTER.categorias())} categorías.")
+
 async def undo_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        last_mov = supabase.table("movimientos").select("*").eq("source", "telegram_bot").order("created_at", desc=True).limit(1).execute()
-        last_card = supabase.table("compras_tarjeta").select("*").eq("source", "telegram_bot").order("created_at", desc=True).limit(1).execute()
+        last_mov, last_card = await asyncio.gather(
+            db_exec(supabase.table("movimientos").select("*").eq("source", "telegram_bot").order("created_at", desc=True).limit(1)),
+            db_exec(supabase.table("compras_tarjeta").select("*").eq("source", "telegram_bot").order("created_at", desc=True).limit(1)),
+        )
         
         m_d = last_mov.data[0] if last_mov.data else None
         c_d = last_card.data[0] if last_card.data else None
@@ -226,8 +647,8 @@ async def undo_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if target:
             if table == "compras_tarjeta":
-                supabase.table("cuotas_tarjeta").delete().eq("compra_id", target['id']).execute()
-            supabase.table(table).delete().eq("id", target['id']).execute()
+                await db_exec(supabase.table("cuotas_tarjeta").delete().eq("compra_id", target['id']))
+            await db_exec(supabase.table(table).delete().eq("id", target['id']))
             monto = target.get('monto') or target.get('monto_total')
             await update.message.reply_text(f"🗑️ Eliminado: {target.get('descripcion')} ({fmt_money(monto)})")
         else:
@@ -237,45 +658,26 @@ async def undo_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Error al deshacer.")
 
 # --- HANDLER PARA ARCHIVOS (FOTOS Y DOCUMENTOS PDF) ---
-async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if ALLOWED_USER_ID and str(update.effective_user.id) != str(ALLOWED_USER_ID): return
-
-    if not model:
-        await update.message.reply_text("⚠️ Error: GEMINI_API_KEY no configurada.")
-        return
-
-    # Acción de escribiendo...
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    status_msg = await update.message.reply_text("👀 Analizando archivo...")
-    
+async def process_receipt(status_msg, file_bytes, mime, queued=False):
+    """Trabajo de la cola: analiza el archivo con IA y registra el gasto."""
     try:
-        file_obj = None
-        mime = ""
-        
-        # CASO 1: DOCUMENTO (PDF o Imagen enviada "como archivo")
-        if update.message.document:
-            mime = update.message.document.mime_type
-            # Verificación básica de tipos soportados por Gemini
-            if mime not in ["application/pdf", "image/jpeg", "image/png", "image/webp"]:
-                await status_msg.edit_text(f"❌ Formato '{mime}' no soportado. Envía PDF o Imágenes.")
+        if queued: await status_msg.edit_text("👀 Analizando archivo...")
+        key = ANALYSIS_CACHE.key(file_bytes, mime)
+
+        # Mismo comprobante ya registrado (y no borrado): no lo duplicamos
+        prev_id = ANALYSIS_CACHE.inserted_id(key)
+        if prev_id:
+            prev = await db_exec(supabase.table("movimientos").select("descripcion, monto, fecha").eq("id", prev_id))
+            if prev.data:
+                p = prev.data[0]
+                await status_msg.edit_text(
+                    f"♻️ Este comprobante ya estaba registrado\n📝 {p['descripcion']}\n💲 `{fmt_money(p['monto'])}`\n📅 {p['fecha']}",
+                    parse_mode=ParseMode.MARKDOWN
+                )
                 return
-            file_obj = await update.message.document.get_file()
-
-        # CASO 2: FOTO (Imagen comprimida normal de Telegram)
-        elif update.message.photo:
-            # Tomamos la resolución más alta
-            file_obj = await update.message.photo[-1].get_file()
-            mime = "image/jpeg"
-        
-        else:
-            await status_msg.edit_text("❌ No se detectó un archivo válido.")
-            return
 
-        # Descargar el archivo a memoria
-        file_bytes = await file_obj.download_as_bytearray()
-        
-        # PROCESAR CON IA
-        data = await analyze_media(file_bytes, mime)
+        # PROCESAR CON IA (o resultado cacheado)
+        data = await analyze_media(file_bytes, mime, key=key)
         
         if not data:
             await status_msg.edit_text("❌ La IA no pudo leer el archivo. Intenta una foto más clara.")
@@ -300,7 +702,7 @@ async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Guardar en Supabase
-        supabase.table("movimientos").insert({
+        res = await db_exec(supabase.table("movimientos").insert({
             "fecha": str(fecha_gasto), 
             "monto": monto, 
             "descripcion": desc,
@@ -308,7 +710,8 @@ async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "categoria_id": cat['id'], 
             "tipo": "GASTO", 
             "source": "telegram_bot"
-        }).execute()
+        }))
+        if res.data: ANALYSIS_CACHE.mark_inserted(key, res.data[0]['id'])
 
         await status_msg.edit_text(
             f"✅ *Gasto Registrado*\n📝 {desc}\n💲 `{fmt_money(monto)}`\n📂 {cat['nombre']}\n📅 {fecha_gasto}",
@@ -319,6 +722,65 @@ async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"File Handler Error: {e}")
         await status_msg.edit_text("❌ Error procesando el archivo.")
 
+async def handle_files(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if ALLOWED_USER_ID and str(update.effective_user.id) != str(ALLOWED_USER_ID): return
+
+    if not model:
+        await update.message.reply_text("⚠️ Error: GEMINI_API_KEY no configurada.")
+        return
+
+    # Acción de escribiendo...
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    status_msg = await update.message.reply_text("👀 Analizando archivo...")
+    
+    try:
+        file_obj = None
+        mime = ""
+        
+        # CASO 1: DOCUMENTO (PDF o Imagen enviada "como archivo")
+        if update.message.document:
+            mime = update.message.document.mime_type
+            # Verificación básica de tipos soportados por Gemini
+            if mime not in ["application/pdf", "image/jpeg", "image/png", "image/webp"]:
+                await status_msg.edit_text(f"❌ Formato '{mime}' no soportado. Envía PDF o Imágenes.")
+                return
+            file_obj = await update.message.document.get_file()
+
+        # CASO 2: FOTO (Imagen comprimida normal de Telegram)
+        elif update.message.photo:
+            # La menor resolución que ya cubre RECEIPT_MAX_PIXELS (o la más alta si ninguna llega)
+            sizes = update.message.photo
+            photo = next((p for p in sizes if p.width * p.height >= RECEIPT_MAX_PIXELS), sizes[-1])
+            file_obj = await photo.get_file()
+            mime = "image/jpeg"
+        
+        else:
+            await status_msg.edit_text("❌ No se detectó un archivo válido.")
+            return
+
+        # Descargar el archivo a memoria
+        file_bytes = await file_obj.download_as_bytearray()
+    except Exception as e:
+        logger.error(f"File Handler Error: {e}")
+        await status_msg.edit_text("❌ Error procesando el archivo.")
+        return
+
+    # Ya analizado antes: se resuelve al instante, sin pasar por la cola
+    if ANALYSIS_CACHE.get(ANALYSIS_CACHE.key(file_bytes, mime)) is not None:
+        await process_receipt(status_msg, file_bytes, mime)
+        return
+
+    # Encolar el análisis (la IA corre en los workers de ANALYSIS, en orden por usuario)
+    # (la lambda lee `position` recién al ejecutarse, cuando ya quedó asignada)
+    position = ANALYSIS.submit(
+        update.effective_user.id,
+        lambda: process_receipt(status_msg, file_bytes, mime, queued=bool(position)),
+    )
+    if position is None:
+        await status_msg.edit_text("⏳ Hay demasiados archivos en cola. Reenvialo en unos minutos.")
+    elif position > 0:
+        await status_msg.edit_text(f"⏳ En cola (posición {position}). Te aviso cuando lo procese.")
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if ALLOWED_USER_ID and str(update.effective_user.id) != str(ALLOWED_USER_ID): return
     text = update.message.text
@@ -344,7 +806,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     acc = None
     try:
-        all_acc = supabase.table("cuentas").select("*").execute().data or []
+        all_acc = MASTER.cuentas()
         words = clean_text.split()
         desc_w = []
         for w in words:
@@ -361,20 +823,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         if acc.get('tipo') == 'CREDITO':
-            c = supabase.table("compras_tarjeta").insert({
+            creadas = await save_compra_tarjeta({
                 "fecha_compra": str(fecha_gasto), "monto_total": monto, "cuotas_total": 1,
                 "cuenta_id": acc['id'], "categoria_id": cat['id'], "descripcion": desc, "source": "telegram_bot", "merchant": desc
-            }).execute()
-            if c.data:
-                supabase.table("cuotas_tarjeta").insert({
-                    "compra_id": c.data[0]['id'], "nro_cuota": 1, "fecha_cuota": str(fecha_gasto), "monto_cuota": monto, "estado": "pendiente"
-                }).execute()
+            })
+            if creadas:
                 await update.message.reply_text(f"💳 *Tarjeta*\n📝 {desc}\n💲 `{fmt_money(monto)}`", parse_mode=ParseMode.MARKDOWN)
         else:
-            supabase.table("movimientos").insert({
+            await db_exec(supabase.table("movimientos").insert({
                 "fecha": str(fecha_gasto), "monto": monto, "descripcion": desc,
                 "cuenta_id": acc['id'], "categoria_id": cat['id'], "tipo": "GASTO", "source": "telegram_bot"
-            }).execute()
+            }))
             await update.message.reply_text(f"✅ *Guardado*\n📝 {desc}\n💲 `{fmt_money(monto)}`", parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         logger.error(f"Text Handler Error: {e}")
@@ -383,18 +842,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ==========================================
 # 4. LIFESPAN / STARTUP
 # ==========================================
+BOT = {"app": None}  # Application activa en modo webhook
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # sin secreto cualquiera que llegue al endpoint podría inyectar updates
+        raise RuntimeError("Modo webhook requiere WEBHOOK_SECRET")
     if not TELEGRAM_TOKEN:
         logger.error("No token found")
         yield
         return
         
-    bot = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # concurrent_updates: los handlers ya no bloquean el loop, así que pueden solaparse
+    bot = ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(BOT_CONCURRENCY).build()
     bot.add_handler(CommandHandler("start", start))
     bot.add_handler(CommandHandler("saldo", reply_balance))
     bot.add_handler(CommandHandler("ayuda", help_command))
     bot.add_handler(CommandHandler("deshacer", undo_last))
+    bot.add_handler(CommandHandler("recargar", reload_masters))
     
     # FILTRO IMPORTANTE: Acepta Fotos OR Documentos (PDF), pero NO comandos
     file_filter = (filters.PHOTO | filters.Document.ALL) & ~filters.COMMAND
@@ -402,20 +868,54 @@ async def lifespan(app: FastAPI):
     
     bot.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
+    # Maestros en memoria + refresco en segundo plano
+    await MASTER.refresh(force=True)
+    refresher = asyncio.create_task(MASTER.run_refresher())
+    ANALYSIS.start()
+
     await bot.initialize()
-    try: await bot.bot.delete_webhook(drop_pending_updates=True)
-    except: pass
     await bot.start()
-    await bot.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        # Sin long-polling: el endpoint recibe los updates y varias réplicas pueden atender detrás de un balanceador
+        try:
+            await bot.bot.set_webhook(url=f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=Update.ALL_TYPES)
+        except Exception as e:
+            logger.error(f"set_webhook error (se siguen aceptando POSTs en {WEBHOOK_PATH}): {e}")
+        BOT["app"] = bot
+    else:
+        try: await bot.bot.delete_webhook(drop_pending_updates=True)
+        except: pass
+        await bot.updater.start_polling(allowed_updates=Update.ALL_TYPES)
     
-    logger.info("Bot iniciado...")
+    logger.info(f"Bot iniciado ({'webhook' if WEBHOOK_URL else 'polling'})...")
     yield
     
-    await bot.updater.stop()
+    refresher.cancel()
+    await ANALYSIS.stop()
+    BOT["app"] = None
+    if bot.updater.running: await bot.updater.stop()
     await bot.stop()
     await bot.shutdown()
+    DB_POOL.shutdown(wait=False)
+    AI_POOL.shutdown(wait=False)
 
 app = FastAPI(lifespan=lifespan)
 
 @app.get("/")
-def health(): return {"status": "ok", "mode": "PDF_FIXED"}
\ No newline at end of file
+def health(): return {"status": "ok", "mode": "PDF_FIXED", "ingest": "webhook" if WEBHOOK_URL else "polling", "analysis": ANALYSIS.stats()}
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    bot = BOT["app"]
+    if bot is None: return Response(status_code=503)
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token") or ""
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token, WEBHOOK_SECRET): return Response(status_code=403)
+    try:
+        update = Update.de_json(await request.json(), bot.bot)
+    except Exception as e:
+        logger.error(f"Webhook payload inválido: {e}")
+        return Response(status_code=400)
+    # Se responde enseguida; los handlers corren en la Application (concurrent_updates)
+    await bot.update_queue.put(update)
+    return Response(status_code=200)
\ No newline at end of file
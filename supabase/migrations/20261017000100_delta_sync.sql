@@ -0,0 +1,66 @@
+-- Delta sync para el espejo local de app.py (LocalMirror).
+--   - updated_at en las tablas con fecha (watermark de sincronización)
+--   - tombstones: registro de borrados para propagarlos al espejo
+
+-- ---------------------------------------------------------
+-- updated_at
+-- ---------------------------------------------------------
+create or replace function set_updated_at() returns trigger
+language plpgsql as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+alter table movimientos     add column if not exists updated_at timestamptz not null default now();
+alter table compras_tarjeta add column if not exists updated_at timestamptz not null default now();
+alter table cuotas_tarjeta  add column if not exists updated_at timestamptz not null default now();
+
+drop trigger if exists trg_movimientos_updated_at on movimientos;
+create trigger trg_movimientos_updated_at before update on movimientos
+  for each row execute function set_updated_at();
+
+drop trigger if exists trg_compras_tarjeta_updated_at on compras_tarjeta;
+create trigger trg_compras_tarjeta_updated_at before update on compras_tarjeta
+  for each row execute function set_updated_at();
+
+drop trigger if exists trg_cuotas_tarjeta_updated_at on cuotas_tarjeta;
+create trigger trg_cuotas_tarjeta_updated_at before update on cuotas_tarjeta
+  for each row execute function set_updated_at();
+
+create index if not exists movimientos_updated_at_idx     on movimientos (updated_at, id);
+create index if not exists compras_tarjeta_updated_at_idx on compras_tarjeta (updated_at, id);
+create index if not exists cuotas_tarjeta_updated_at_idx  on cuotas_tarjeta (updated_at, id);
+
+-- ---------------------------------------------------------
+-- tombstones (también captura las cuotas borradas en cascada)
+-- ---------------------------------------------------------
+create table if not exists tombstones (
+  id bigserial primary key,
+  tabla text not null,
+  row_id text not null,
+  deleted_at timestamptz not null default now()
+);
+
+create index if not exists tombstones_deleted_at_idx on tombstones (deleted_at, id);
+
+create or replace function record_tombstone() returns trigger
+language plpgsql as $$
+begin
+  insert into tombstones (tabla, row_id) values (tg_table_name, old.id::text);
+  return old;
+end;
+$$;
+
+drop trigger if exists trg_movimientos_tombstone on movimientos;
+create trigger trg_movimientos_tombstone after delete on movimientos
+  for each row execute function record_tombstone();
+
+drop trigger if exists trg_compras_tarjeta_tombstone on compras_tarjeta;
+create trigger trg_compras_tarjeta_tombstone after delete on compras_tarjeta
+  for each row execute function record_tombstone();
+
+drop trigger if exists trg_cuotas_tarjeta_tombstone on cuotas_tarjeta;
+create trigger trg_cuotas_tarjeta_tombstone after delete on cuotas_tarjeta
+  for each row execute function record_tombstone();
@@ -0,0 +1,99 @@
+-- Resumen mensual mantenido por triggers (lo lee el /saldo del bot en una sola fila).
+--   ingresos        movimientos tipo INGRESO
+--   gastos_cash     movimientos tipo GASTO
+--   gastos_tarjeta  cuotas_tarjeta por mes de cuota + movimientos COMPRA_TARJETA viejos
+-- Mismo criterio que el Dashboard de app.py.
+
+create table if not exists resumen_mensual (
+  mes date primary key,  -- primer día del mes
+  ingresos numeric not null default 0,
+  gastos_cash numeric not null default 0,
+  gastos_tarjeta numeric not null default 0,
+  updated_at timestamptz not null default now()
+);
+
+-- Suma (o resta) deltas al mes; el upsert es atómico por fila
+create or replace function resumen_mensual_aplicar(p_fecha date, p_ing numeric, p_cash numeric, p_tj numeric)
+returns void
+language plpgsql as $$
+begin
+  if p_fecha is null or (p_ing = 0 and p_cash = 0 and p_tj = 0) then
+    return;
+  end if;
+  insert into resumen_mensual as r (mes, ingresos, gastos_cash, gastos_tarjeta)
+  values (date_trunc('month', p_fecha)::date, p_ing, p_cash, p_tj)
+  on conflict (mes) do update
+    set ingresos       = r.ingresos + excluded.ingresos,
+        gastos_cash    = r.gastos_cash + excluded.gastos_cash,
+        gastos_tarjeta = r.gastos_tarjeta + excluded.gastos_tarjeta,
+        updated_at     = now();
+end;
+$$;
+
+create or replace function resumen_mensual_movimientos() returns trigger
+language plpgsql as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    perform resumen_mensual_aplicar(
+      old.fecha,
+      -case when old.tipo = 'INGRESO' then coalesce(old.monto, 0) else 0 end,
+      -case when old.tipo = 'GASTO' then coalesce(old.monto, 0) else 0 end,
+      -case when old.tipo = 'COMPRA_TARJETA' then coalesce(old.monto, 0) else 0 end);
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform resumen_mensual_aplicar(
+      new.fecha,
+      case when new.tipo = 'INGRESO' then coalesce(new.monto, 0) else 0 end,
+      case when new.tipo = 'GASTO' then coalesce(new.monto, 0) else 0 end,
+      case when new.tipo = 'COMPRA_TARJETA' then coalesce(new.monto, 0) else 0 end);
+  end if;
+  return null;
+end;
+$$;
+
+create or replace function resumen_mensual_cuotas() returns trigger
+language plpgsql as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    perform resumen_mensual_aplicar(old.fecha_cuota, 0, 0, -coalesce(old.monto_cuota, 0));
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform resumen_mensual_aplicar(new.fecha_cuota, 0, 0, coalesce(new.monto_cuota, 0));
+  end if;
+  return null;
+end;
+$$;
+
+drop trigger if exists trg_movimientos_resumen on movimientos;
+create trigger trg_movimientos_resumen after insert or update of fecha, tipo, monto or delete on movimientos
+  for each row execute function resumen_mensual_movimientos();
+
+drop trigger if exists trg_cuotas_tarjeta_resumen on cuotas_tarjeta;
+create trigger trg_cuotas_tarjeta_resumen after insert or update of fecha_cuota, monto_cuota or delete on cuotas_tarjeta
+  for each row execute function resumen_mensual_cuotas();
+
+-- Reconstrucción completa (backfill inicial o si alguna vez se desincroniza)
+create or replace function resumen_mensual_rebuild() returns void
+language plpgsql as $$
+begin
+  lock table resumen_mensual in exclusive mode;
+  delete from resumen_mensual;
+  insert into resumen_mensual (mes, ingresos, gastos_cash, gastos_tarjeta)
+  select mes, sum(ing), sum(cash), sum(tj)
+  from (
+    select date_trunc('month', fecha)::date as mes,
+           case when tipo = 'INGRESO' then coalesce(monto, 0) else 0 end as ing,
+           case when tipo = 'GASTO' then coalesce(monto, 0) else 0 end as cash,
+           case when tipo = 'COMPRA_TARJETA' then coalesce(monto, 0) else 0 end as tj
+    from movimientos
+    where fecha is not null
+    union all
+    select date_trunc('month', fecha_cuota)::date, 0, 0, coalesce(monto_cuota, 0)
+    from cuotas_tarjeta
+    where fecha_cuota is not null
+  ) t
+  group by mes;
+end;
+$$;
+
+select resumen_mensual_rebuild();
@@ -0,0 +1,24 @@
+-- Alta atómica de compras con tarjeta + su calendario de cuotas, en un solo request.
+-- Recibe un array JSON de compras (mismas claves que compra_payload en app.py) y
+-- devuelve las compras creadas. Si algo falla no queda ninguna compra sin cuotas.
+-- La cuota i vence en fecha_compra + (i-1) meses (fin de mes recortado, igual que relativedelta).
+
+create or replace function crear_compras_tarjeta(p_compras jsonb)
+returns setof compras_tarjeta
+language sql
+as $$
+  with nuevas as (
+    insert into compras_tarjeta (fecha_compra, monto_total, cuotas_total, cuenta_id, categoria_id,
+                                 descripcion, source, raw_reference, merchant)
+    select c.fecha_compra, c.monto_total, greatest(coalesce(c.cuotas_total, 1), 1), c.cuenta_id, c.categoria_id,
+           c.descripcion, c.source, c.raw_reference, coalesce(c.merchant, c.descripcion)
+    from jsonb_populate_recordset(null::compras_tarjeta, p_compras) c
+    returning *
+  ), cuotas as (
+    insert into cuotas_tarjeta (compra_id, nro_cuota, fecha_cuota, monto_cuota, estado)
+    select n.id, g, (n.fecha_compra + (g - 1) * interval '1 month')::date, n.monto_total / n.cuotas_total, 'pendiente'
+    from nuevas n
+    cross join lateral generate_series(1, n.cuotas_total) g
+  )
+  select * from nuevas;
+$$;
@@ -0,0 +1,32 @@
+-- Clave de idempotencia para altas que se pueden repetir (p.ej. "Procesar" fijos dos veces).
+-- Formato usado por app.py: 'fijo:<suscripcion_id>:<YYYY-MM>'. NULL = sin control (filas normales).
+
+alter table movimientos     add column if not exists idempotency_key text;
+alter table compras_tarjeta add column if not exists idempotency_key text;
+
+-- índices únicos completos (no parciales) para que sirvan de target a on conflict / upsert de PostgREST;
+-- los NULL no chocan entre sí
+create unique index if not exists movimientos_idempotency_key_uq     on movimientos (idempotency_key);
+create unique index if not exists compras_tarjeta_idempotency_key_uq on compras_tarjeta (idempotency_key);
+
+-- crear_compras_tarjeta: ahora guarda la clave y saltea las compras ya creadas (sin duplicar cuotas)
+create or replace function crear_compras_tarjeta(p_compras jsonb)
+returns setof compras_tarjeta
+language sql
+as $$
+  with nuevas as (
+    insert into compras_tarjeta (fecha_compra, monto_total, cuotas_total, cuenta_id, categoria_id,
+                                 descripcion, source, raw_reference, merchant, idempotency_key)
+    select c.fecha_compra, c.monto_total, greatest(coalesce(c.cuotas_total, 1), 1), c.cuenta_id, c.categoria_id,
+           c.descripcion, c.source, c.raw_reference, coalesce(c.merchant, c.descripcion), c.idempotency_key
+    from jsonb_populate_recordset(null::compras_tarjeta, p_compras) c
+    on conflict (idempotency_key) do nothing
+    returning *
+  ), cuotas as (
+    insert into cuotas_tarjeta (compra_id, nro_cuota, fecha_cuota, monto_cuota, estado)
+    select n.id, g, (n.fecha_compra + (g - 1) * interval '1 month')::date, n.monto_total / n.cuotas_total, 'pendiente'
+    from nuevas n
+    cross join lateral generate_series(1, n.cuotas_total) g
+  )
+  select * from nuevas;
+$$;
@@ -0,0 +1,14 @@
+-- Marca estructurada para inversiones (antes: descripción "Inversión: ..." + tipo TRANSFERENCIA).
+-- La página Inversiones consulta por subtipo con índice, sin rango de fechas.
+
+alter table movimientos add column if not exists subtipo text;
+
+create index if not exists movimientos_subtipo_fecha_idx
+  on movimientos (subtipo, fecha desc, id desc)
+  where subtipo is not null;
+
+-- backfill: mismo criterio que usaba la app para reconocerlas
+update movimientos
+   set subtipo = 'INVERSION'
+ where subtipo is null
+   and descripcion ilike '%Inversión:%';
@@ -0,0 +1,8 @@
+-- Índices para la paginación keyset del Historial (app.py: _fetch_history_page).
+-- Cada página es "order by fecha desc, id desc limit n" con cursor (fecha, id) < (c_fecha, c_id).
+
+create index if not exists movimientos_fecha_id_idx
+  on movimientos (fecha desc, id desc);
+
+create index if not exists compras_tarjeta_fecha_compra_id_idx
+  on compras_tarjeta (fecha_compra desc, id desc);
@@ -0,0 +1,11 @@
+-- Índices para buscar / deshacer una importación por prefijo de raw_reference
+-- (app.py: count_by_reference / ids_by_reference, "raw_reference like 'archivo.xlsx:%'").
+-- text_pattern_ops: el LIKE con prefijo usa el índice aunque la collation no sea "C".
+
+create index if not exists movimientos_raw_reference_prefix_idx
+  on movimientos (raw_reference text_pattern_ops)
+  where raw_reference is not null;
+
+create index if not exists compras_tarjeta_raw_reference_prefix_idx
+  on compras_tarjeta (raw_reference text_pattern_ops)
+  where raw_reference is not null;
@@ -0,0 +1,16 @@
+-- Baja de compras de tarjeta con sus cuotas en un solo statement (atómico), como crear_compras_tarjeta.
+-- p_compras: [{"id": ...}, ...]; jsonb_populate_recordset tipa el id igual que la tabla.
+-- Devuelve las compras borradas (app.py calcula de ahí las fechas de cuotas a invalidar).
+
+create or replace function borrar_compras_tarjeta(p_compras jsonb)
+returns setof compras_tarjeta
+language sql
+as $$
+  with ids as (
+    select r.id from jsonb_populate_recordset(null::compras_tarjeta, p_compras) r
+  ), cuotas as (
+    delete from cuotas_tarjeta q using ids where q.compra_id = ids.id
+  )
+  delete from compras_tarjeta c using ids where c.id = ids.id
+  returning c.*;
+$$;